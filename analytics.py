@@ -0,0 +1,24 @@
+# analytics.py
+import os
+
+from process_pool import BoundedProcessPool
+
+ANALYTICS_POOL_SIZE = int(os.getenv("ANALYTICS_POOL_SIZE", "2"))
+# Jobs allowed to wait for a free worker; beyond that they are rejected immediately
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "32"))
+# Jobs a worker runs before it is replaced by a fresh one, which hands the memory of the
+# analytics stack back to the system; 0 keeps workers for the life of the pool
+ANALYTICS_MAX_TASKS_PER_CHILD = int(os.getenv("ANALYTICS_MAX_TASKS_PER_CHILD", "100"))
+
+
+class AnalyticsPoolBusy(Exception):
+    pass
+
+
+# Runs the numpy / scikit-learn work (feedback clustering, batch predictions) in separate
+# processes, so it neither competes with request handling for the GIL nor loads the
+# analytics stack into the API workers
+analytics_pool = BoundedProcessPool(
+    "Analytics", ANALYTICS_POOL_SIZE, ANALYTICS_QUEUE_SIZE, AnalyticsPoolBusy,
+    max_tasks_per_child=ANALYTICS_MAX_TASKS_PER_CHILD,
+)
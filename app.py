@@ -1,31 +1,55 @@
 # app.py
 import os
+import gzip
 import logging
 import secrets
-import json
+import tempfile
 import uuid 
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from typing import List, Optional
 import redis.asyncio as redis  
 
 from interactions import (
-    InteractionCreate, Token, Location, CreateUserRequest, Login, ValidCookieAndUser, Token, InteractionsList, insert_interaction, get_all_interactions,
-    get_interactions_by_user, init_db, create_user, login, get_user
+    InteractionCreate, Token, Location, CreateUserRequest, Login, ValidCookieAndUser, Token, InteractionsList, InteractionEvent, PredictionBatchRequest,
+    get_interactions_page_async, iter_interactions_async, INTERACTIONS_PAGE_SIZE, INTERACTIONS_MAX_PAGE_SIZE, ROLLUP_GRANULARITIES, BUCKET_WIDTHS, init_db,
+    create_user_async, login_async, get_user_async, insert_interactions_async, user_interaction_rows, events_to_rows, to_local_naive
 )
 
-from jwtUtils import set_secret_key, role_required, create_access_token, get_current_user, get_current_username_optional, isTokenValidAndUser
-from utils import compute_usage_stats, compute_interactions_stats, compute_feedback_stats, predict_next_action
+from jwtUtils import load_secret_key, set_redis_client, role_required, create_access_token, get_current_user, get_current_username_optional, isTokenValidAndUser, revoke_token, get_token_cache_stats, oauth2_scheme
+from utils import compute_feedback_stats, predict_next_action, predict_top_actions, PREDICTION_BATCH_MAX_USERS, get_action_timeseries, get_user_timeseries, ROLLUP_MAX_BUCKETS
+from ingestion import INGESTION_MODE, IngestionPipeline, IngestionQueueFull, ingest_ndjson
+from hashing import hash_pool, HashPoolBusy
+from analytics import analytics_pool, AnalyticsPoolBusy
+from transfer import export_interactions, import_file
+from retention import RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_MAX_BATCHES, archive_interactions
+from cache import stats_cache, dumps, PREDICTION_CACHE_TTL, PREDICTION_CACHE_STALE_TTL
+from scheduler import scheduler, USAGE_STATS_INTERVAL, INTERACTIONS_STATS_INTERVAL, FEEDBACK_STATS_INTERVAL
+from metrics import MetricsMiddleware, register_stats, render as render_metrics, watch_threadpool
+from locks import redis_lock
+from live_stats import record_interactions, get_usage_stats as get_live_usage_stats, get_interactions_stats as get_live_interactions_stats, reconcile, STATS_RECONCILE_INTERVAL
+import asyncio
 from fastapi.concurrency import run_in_threadpool
 
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
+from datetime import datetime, timedelta
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 
 
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis")
+STARTUP_LOCK_KEY = "startup_lock"
+# Longest a worker may hold the startup lock (migrations included) before another takes it
+STARTUP_LOCK_TIMEOUT = float(os.getenv("STARTUP_LOCK_TIMEOUT", "600"))
+
 redis_client = None
+# Same server, raw bytes: the caches hold encoded response bodies
+raw_redis_client = None
+ingestion_pipeline = None
 admin_credentials = {}  
 app = FastAPI()
 
@@ -38,28 +62,87 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+def startup_lock():
+    # Workers run the migrations and the admin bootstrap one after the other: the first
+    # does the work, the next ones find it done
+    return redis_lock(redis_client, STARTUP_LOCK_KEY, STARTUP_LOCK_TIMEOUT, wait_timeout=STARTUP_LOCK_TIMEOUT)
+
 
 @app.on_event("startup")
 async def startup_event():
-    global redis_client
-    redis_client = redis.from_url("redis://redis", encoding="utf8", decode_responses=True)
+    global redis_client, raw_redis_client, ingestion_pipeline
+    redis_client = redis.from_url(REDIS_URL, encoding="utf8", decode_responses=True)
+    raw_redis_client = redis.from_url(REDIS_URL)
+    set_redis_client(redis_client)
+    stats_cache.redis = raw_redis_client
+    scheduler.redis = raw_redis_client
 
-    SECRET_KEY = secrets.token_urlsafe(32)
-    set_secret_key(SECRET_KEY)
     logging.basicConfig(level=logging.INFO)
+    await load_secret_key()
     logging.info("SECRET_KEY is set.")
+    hash_pool.start()
 
-    await run_in_threadpool(init_db)
+    watch_threadpool()
+    register_stats("hashing", hash_pool.stats)
+    register_stats("analytics", analytics_pool.stats)
+    register_stats("token_cache", get_token_cache_stats)
+    register_stats("cache", stats_cache.stats)
+    register_stats("scheduler", scheduler.stats)
 
-    admin_username = "admin"
-    admin_password = secrets.token_urlsafe(16)
+    async with startup_lock():
+        await run_in_threadpool(init_db)
+
+        admin_username = "admin"
+        admin_password = secrets.token_urlsafe(16)
+
+        admin_user = await get_user_async(admin_username)
+        if not admin_user:
+            await create_user_async(admin_username, admin_password, True)
+            logging.info(f"Admin user '{admin_username}' created with password '{admin_password}'")
+        else:
+            logging.info(f"Admin user '{admin_username}' already exists.")
+
+    if INGESTION_MODE == "batched":
+        ingestion_pipeline = IngestionPipeline(on_flush=after_insert)
+        await ingestion_pipeline.start()
+        register_stats("ingestion", ingestion_pipeline.stats)
+        logging.info("Batched ingestion enabled.")
+
+    # Precomputed on a schedule by whichever worker holds the leader lock
+    scheduler.add_job("usage_stats", lambda: get_live_usage_stats(redis_client), USAGE_STATS_INTERVAL)
+    scheduler.add_job("interactions_stats", lambda: get_live_interactions_stats(redis_client), INTERACTIONS_STATS_INTERVAL)
+    scheduler.add_job("feedback_stats", compute_feedback_stats, FEEDBACK_STATS_INTERVAL)
+    scheduler.add_job("live_stats_reconciliation", lambda: reconcile(redis_client, wait=False), STATS_RECONCILE_INTERVAL, publish=False)
+    if RETENTION_DAYS > 0:
+        scheduler.add_job(
+            "retention",
+            lambda: asyncio.to_thread(archive_interactions, max_batches=RETENTION_MAX_BATCHES),
+            RETENTION_INTERVAL,
+            publish=False,
+        )
+    scheduler.start()
 
-    admin_user = await run_in_threadpool(get_user, admin_username)
-    if not admin_user:
-        await run_in_threadpool(create_user, admin_username, admin_password, True)
-        logging.info(f"Admin user '{admin_username}' created with password '{admin_password}'")
-    else:
-        logging.info(f"Admin user '{admin_username}' already exists.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    if ingestion_pipeline is not None:
+        await ingestion_pipeline.stop()
+        logging.info("Ingestion queue flushed.")
+    hash_pool.shutdown()
+    analytics_pool.shutdown()
+    # Last, once nothing can use them anymore (the ingestion flush updates the live counters)
+    await redis_client.aclose()
+    await raw_redis_client.aclose()
+
+
+async def after_insert(rows):
+    # rows: committed (username, action, timestamp) tuples. Updates the live counters and
+    # drops every cached value derived from these users' history.
+    await record_interactions(redis_client, rows)
+    await stats_cache.invalidate_tags(*{f"user:{username}" for username, _, _ in rows})
 
 
 @app.post("/interactions/submit")
@@ -67,79 +150,174 @@ async def create_interaction(
     interaction: InteractionCreate,
     username: str = Depends(get_current_username_optional, use_cache=False) 
 ):
-    await run_in_threadpool(insert_interaction, username, interaction)
-    
-    cache_key = f"interactions_{username}"
-    
-    interactions = await run_in_threadpool(get_interactions_by_user, username)
-    interactions_data = jsonable_encoder(interactions)
-    
-    await redis_client.set(cache_key, json.dumps(interactions_data), ex=30)  # 5 minutes expiration
-    
-    await redis_client.delete("usage_stats")
-    await redis_client.delete("interactions_stats")
+    if ingestion_pipeline is not None:
+        try:
+            await ingestion_pipeline.submit(username, interaction.action)
+        except IngestionQueueFull:
+            raise HTTPException(status_code=503, detail="Ingestion queue full, retry later")
+        return {"message": "Interaction enregistrée"}
+
+    rows = [(username, interaction.action, datetime.now())]
+    await insert_interactions_async(rows, server_timestamps=True)
+    await after_insert(rows)
     
     return {"message": "Interaction enregistrée"}
 
 
+class InteractionsQuery:
+    def __init__(
+        self,
+        after_id: Optional[int] = None,
+        limit: int = Query(INTERACTIONS_PAGE_SIZE, ge=1, le=INTERACTIONS_MAX_PAGE_SIZE),
+        since: Optional[datetime] = Query(None, alias="from"),
+        until: Optional[datetime] = Query(None, alias="to"),
+        format: str = Query("json", pattern="^(json|ndjson)$"),
+    ):
+        self.after_id = after_id
+        self.limit = limit
+        self.since = to_local_naive(since)
+        self.until = to_local_naive(until)
+        self.format = format
+
+
+def json_response(value, headers=None):
+    # Encoded once by orjson, bypassing jsonable_encoder and FastAPI's own serialization
+    return Response(dumps(value), media_type="application/json", headers=headers)
+
+
+def cached_json_response(request, payload):
+    # payload: (body, encoding) as stored by the caches, sent as is when the client accepts it
+    body, encoding = payload
+    if encoding is None:
+        return Response(body, media_type="application/json")
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = encoding
+    else:
+        body = gzip.decompress(body)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def stream_interactions_ndjson(username, params):
+    async for chunk in iter_interactions_async(username, params.since, params.until):
+        yield b"".join(dumps(row) + b"\n" for row in chunk)
+
+
+async def interactions_page_response(username, params):
+    if params.format == "ndjson":
+        return StreamingResponse(stream_interactions_ndjson(username, params), media_type="application/x-ndjson")
+
+    page = await get_interactions_page_async(
+        username, params.after_id, params.limit, params.since, params.until
+    )
+    if not page and username is not None and params.after_id is None:
+        raise HTTPException(status_code=404, detail=f"No interactions found for user {username}")
+    headers = {}
+    if len(page) == params.limit:
+        headers["X-Next-After-Id"] = str(page[-1]["id"])
+    return json_response(page, headers)
+
+
 @app.get("/interactions", dependencies=[Depends(role_required("admin"))])
-async def read_interactions():
-    cache_key = "interactions_all"
-    cached_data = await redis_client.get(cache_key)
-    if cached_data:
-        return json.loads(cached_data)
-    interactions = await run_in_threadpool(get_all_interactions)
-    interactions_data = jsonable_encoder(interactions)
-    await redis_client.set(cache_key, json.dumps(interactions_data), ex=30)  # Cache for 5 minutes
-    return interactions_data
+async def read_interactions(params: InteractionsQuery = Depends()):
+    return await interactions_page_response(None, params)
 
 @app.get("/interactions/{username}", dependencies=[Depends(role_required("admin"))])
-async def read_user_interactions(username: str):
-    interactions = await run_in_threadpool(get_interactions_by_user, username)
-    
-    if not interactions:
-        raise HTTPException(status_code=404, detail=f"No interactions found for user {username}")
-    
-    interactions_data = jsonable_encoder(interactions)
-    await redis_client.set(f"interactions_{username}", json.dumps(interactions_data), ex=30)
-    return interactions_data
+async def read_user_interactions(username: str, params: InteractionsQuery = Depends()):
+    return await interactions_page_response(username, params)
+
 
+async def precomputed_response(request, name):
+    # Statistics are only read here, never computed: see the jobs registered at startup
+    try:
+        payload = await scheduler.read(name)
+    except redis.RedisError as e:
+        logging.error(f"Redis error while reading {name}: {e}")
+        payload = None
+    if payload is None:
+        raise HTTPException(status_code=503, detail="Statistics not computed yet, retry later", headers={"Retry-After": "5"})
+    return cached_json_response(request, payload)
 
 @app.get("/stats/usage", dependencies=[Depends(role_required("admin"))])
-async def get_usage_stats():
-    cache_key = "usage_stats"
-    cached_data = await redis_client.get(cache_key)
-    if cached_data:
-        return {"usage_stats": json.loads(cached_data)}
-    usage_stats = await compute_usage_stats()
-    await redis_client.set(cache_key, json.dumps(usage_stats), ex=3600)  # Cache for 1 hour
-    return {"usage_stats": usage_stats}
+async def get_usage_stats(request: Request):
+    # Snapshot of the live counters maintained on ingest, see live_stats.py
+    return await precomputed_response(request, "usage_stats")
 
 @app.get("/stats/interactions", dependencies=[Depends(role_required("admin"))])
-async def get_interactions_stats():
-    cache_key = "interactions_stats"
-    cached_data = await redis_client.get(cache_key)
-    if cached_data:
-        return {"interactions_stats": json.loads(cached_data)}
-    interaction_stats = await compute_interactions_stats()
-    await redis_client.set(cache_key, json.dumps(interaction_stats), ex=1800)  # Cache for 30 minutes
-    return {"interactions_stats": interaction_stats}
+async def get_interactions_stats(request: Request):
+    return await precomputed_response(request, "interactions_stats")
 
 @app.get("/stats/feedback", dependencies=[Depends(role_required("admin"))])
-async def get_feedback_stats():
-    cache_key = "feedback_stats"
-    cached_data = await redis_client.get(cache_key)
-    if cached_data:
-        return {"feedback_stats": json.loads(cached_data)}
-    feedback_stats = await compute_feedback_stats()
-    await redis_client.set(cache_key, json.dumps(feedback_stats), ex=7200)  # Cache for 2 hours
-    return {"feedback_stats": feedback_stats}
+async def get_feedback_stats(request: Request):
+    return await precomputed_response(request, "feedback_stats")
+
+class TimeseriesQuery:
+    def __init__(
+        self,
+        since: Optional[datetime] = Query(None, alias="from"),
+        until: Optional[datetime] = Query(None, alias="to"),
+        granularity: str = "hour",
+    ):
+        if granularity not in ROLLUP_GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(ROLLUP_GRANULARITIES)}")
+        self.until = to_local_naive(until) or datetime.now()
+        self.since = to_local_naive(since) or self.until - timedelta(days=1)
+        self.granularity = granularity
+        if self.since >= self.until:
+            raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+        if (self.until - self.since) / BUCKET_WIDTHS[granularity] > ROLLUP_MAX_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Time range covers more than {ROLLUP_MAX_BUCKETS} buckets, use a coarser granularity")
+
+
+@app.get("/stats/timeseries", dependencies=[Depends(role_required("admin"))])
+async def get_timeseries(action: Optional[str] = None, params: TimeseriesQuery = Depends()):
+    series = await get_action_timeseries(params.since, params.until, params.granularity, action)
+    return {"granularity": params.granularity, "from": params.since, "to": params.until, "timeseries": series}
+
+@app.get("/stats/timeseries/users", dependencies=[Depends(role_required("admin"))])
+async def get_users_timeseries(username: Optional[str] = None, params: TimeseriesQuery = Depends()):
+    series = await get_user_timeseries(params.since, params.until, params.granularity, username)
+    return {"granularity": params.granularity, "from": params.since, "to": params.until, "timeseries": series}
+
+@app.get("/stats/ingestion", dependencies=[Depends(role_required("admin"))])
+async def get_ingestion_stats():
+    if ingestion_pipeline is None:
+        return {"ingestion_stats": {"mode": INGESTION_MODE}}
+    return {"ingestion_stats": ingestion_pipeline.stats()}
+
+@app.get("/stats/hashing", dependencies=[Depends(role_required("admin"))])
+async def get_hashing_stats():
+    return {"hashing_stats": hash_pool.stats()}
+
+@app.get("/stats/analytics", dependencies=[Depends(role_required("admin"))])
+async def get_analytics_stats():
+    return {"analytics_stats": analytics_pool.stats()}
+
+@app.get("/stats/tokens", dependencies=[Depends(role_required("admin"))])
+async def get_tokens_stats():
+    return {"token_cache_stats": get_token_cache_stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format; keep this endpoint on the internal network
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/stats/cache", dependencies=[Depends(role_required("admin"))])
+async def get_cache_stats():
+    return {"cache_stats": stats_cache.stats()}
+
+@app.get("/stats/scheduler", dependencies=[Depends(role_required("admin"))])
+async def get_scheduler_stats():
+    return {"scheduler_stats": scheduler.stats()}
 
 @app.post("/create_user")
 async def create_user_end(user: CreateUserRequest):
     try:
-        created_user = await run_in_threadpool(create_user, user.username, user.password, False)
+        created_user = await create_user_async(user.username, user.password, False)
         return {"message": "User created", "username": created_user.username}
+    except HashPoolBusy:
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
     except IntegrityError:
         raise HTTPException(status_code=400, detail="Username already exists")
     except SQLAlchemyError as e:
@@ -152,7 +330,10 @@ async def create_user_end(user: CreateUserRequest):
 
 @app.post("/login", response_model=Token)
 async def login_end(user: Login):
-    user_in_db = await run_in_threadpool(login, user.username, user.password)
+    try:
+        user_in_db = await login_async(user.username, user.password)
+    except HashPoolBusy:
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
     if not user_in_db:
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
@@ -167,28 +348,103 @@ async def login_end(user: Login):
 
 @app.post("/check-token", response_model=ValidCookieAndUser)
 async def verify_cookie(token: Token):
-    response = await run_in_threadpool(isTokenValidAndUser, token.access_token)
+    # Served from the verified-token cache, no threadpool hop needed
+    response = await isTokenValidAndUser(token.access_token)
     return response
 
-@app.get("/predict_next_action/{username}", dependencies=[Depends(role_required("admin"))])
-async def get_next_action_prediction(username: str):
-    cache_key = f"next_action_prediction_{username}"
+@app.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme), current_user: dict = Depends(get_current_user)):
     try:
-        cached_data = await redis_client.get(cache_key)
-        if cached_data:
-            return json.loads(cached_data)
-        prediction = await predict_next_action(username)
-        await redis_client.set(cache_key, json.dumps(prediction), ex=2)  # Cache for 10 sec
-        return prediction
+        await revoke_token(token)
     except redis.RedisError as e:
-        logging.error(f"Redis error: {e}")
-        prediction = await predict_next_action(username)
-        return prediction
+        logging.error(f"Redis error while revoking token: {e}")
+        raise HTTPException(status_code=503, detail="Token revocation unavailable")
+    return {"message": "Token revoked", "username": current_user["username"]}
+
+@app.get("/predict_next_action/{username}", dependencies=[Depends(role_required("admin"))])
+async def get_next_action_prediction(username: str, request: Request):
+    payload = await stats_cache.get_or_compute(
+        f"next_action_prediction:{username}", lambda: predict_next_action(username),
+        ttl=PREDICTION_CACHE_TTL, stale_ttl=PREDICTION_CACHE_STALE_TTL, name="next_action_prediction",
+        tags=[f"user:{username}", "all"],
+    )
+    return cached_json_response(request, payload)
+
+@app.post("/predict_next_action/batch", dependencies=[Depends(role_required("admin"))])
+async def get_next_action_predictions(request: PredictionBatchRequest):
+    # Top-k next actions for a list of users, or for every user active since a given time
+    if (request.usernames is None) == (request.since is None):
+        raise HTTPException(status_code=400, detail="Provide either 'usernames' or 'since'")
+    if request.usernames is not None and len(request.usernames) > PREDICTION_BATCH_MAX_USERS:
+        raise HTTPException(status_code=400, detail=f"At most {PREDICTION_BATCH_MAX_USERS} usernames per request")
+    try:
+        return json_response(await predict_top_actions(request.usernames, to_local_naive(request.since), request.k))
+    except AnalyticsPoolBusy:
+        raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
 
     
+@app.get("/export/interactions", dependencies=[Depends(role_required("admin"))])
+async def export_interactions_end(
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    username: Optional[str] = None,
+    since: Optional[datetime] = Query(None, alias="from"),
+    until: Optional[datetime] = Query(None, alias="to"),
+):
+    try:
+        chunks = export_interactions(format, username, to_local_naive(since), to_local_naive(until))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    media_type = "application/vnd.apache.parquet" if format == "parquet" else "text/csv"
+    return StreamingResponse(
+        chunks, media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="interactions.{format}"'},
+    )
+
+@app.post("/import/interactions", dependencies=[Depends(role_required("admin"))])
+async def import_interactions_end(request: Request, format: str = Query("csv", pattern="^(csv|parquet)$")):
+    # The upload is spooled to disk first: Parquet keeps its schema at the end of the file
+    with tempfile.NamedTemporaryFile(suffix=f".{format}") as upload:
+        # File writes block: they run in the threadpool, off the event loop
+        async for data in request.stream():
+            await run_in_threadpool(upload.write, data)
+        await run_in_threadpool(upload.flush)
+        try:
+            count = await run_in_threadpool(import_file, upload.name, format)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        await stats_cache.invalidate_tags("all")
+        await reconcile(redis_client)
+    except redis.RedisError as e:
+        logging.error(f"Cache and live stats not refreshed after import: {e}")
+    return {"message": "Interactions enregistrées", "count": count}
+
 @app.post("/set/user-interactions/list", dependencies=[Depends(role_required("admin"))])
-async def set_user_interactions_list(il: InteractionsList):
-    interactions_list = il.interactions.split(",")
-    for interaction in interactions_list:
-        await run_in_threadpool(insert_interaction, il.username, InteractionCreate(action=interaction))
-    return {"message": "Interactions enregistrées"}
\ No newline at end of file
+async def set_user_interactions_list(request: Request, username: Optional[str] = None):
+    # Accepts the legacy {"username", "interactions": "a,b,c"} body, a JSON array of
+    # events, or an NDJSON stream (Content-Type: application/x-ndjson) for large backfills
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("application/x-ndjson"):
+            count = await ingest_ndjson(request.stream(), username, on_rows=after_insert)
+            return {"message": "Interactions enregistrées", "count": count}
+
+        payload = await request.json()
+        if isinstance(payload, list):
+            events = TypeAdapter(List[InteractionEvent]).validate_python(payload)
+            rows = events_to_rows(events, username)
+            # Client timestamps are stored as sent: only a list without any is clamped
+            server_timestamps = all(item.timestamp is None for item in events)
+        else:
+            il = InteractionsList.model_validate(payload)
+            rows = user_interaction_rows(il.username, il.interactions.split(","))
+            server_timestamps = True
+        count = await insert_interactions_async(rows, server_timestamps)
+        await after_insert(rows)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Interactions enregistrées", "count": count}
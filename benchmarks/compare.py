@@ -0,0 +1,60 @@
+# benchmarks/compare.py
+# Compares two result files written by benchmarks/run.py (or benchmarks/startup.py):
+#   python -m benchmarks.compare benchmarks/results/before.json benchmarks/results/after.json
+import argparse
+import json
+
+
+def change(before, after):
+    if not before or after is None:
+        return "      n/a"
+    return f"{(after - before) / before * 100:+8.1f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before: {before.get('commit')}  after: {after.get('commit')}")
+    if before.get("parameters") != after.get("parameters"):
+        print("warning: the runs used different parameters")
+    print(f"{'scenario':20} {'req/s':>32}  {'p50 ms':>32}  {'p99 ms':>32}")
+    for scenario, result in after["results"].items():
+        previous = before["results"].get(scenario)
+        if previous is None or "throughput" not in result:
+            continue
+        columns = []
+        for key, scale in (("throughput", 1), ("p50", 1000), ("p99", 1000)):
+            old, new = previous.get(key), result.get(key)
+            old_text = f"{old * scale:9.2f}" if old is not None else "      n/a"
+            new_text = f"{new * scale:9.2f}" if new is not None else "      n/a"
+            columns.append(f"{old_text} -> {new_text} {change(old, new)}")
+        print(f"{scenario:20} " + "  ".join(columns))
+
+    # Written by benchmarks/startup.py
+    startup_before = before["results"].get("startup")
+    startup_after = after["results"].get("startup")
+    if startup_before and startup_after:
+        print(f"{'startup':26} {'before':>9} -> {'after':>9}")
+        for key, unit, scale in (
+            ("import_seconds", "ms", 1000),
+            ("startup_seconds", "ms", 1000),
+            ("rss_mb", "MB", 1),
+            ("rss_after_feedback_mb", "MB", 1),
+        ):
+            old, new = startup_before.get(key), startup_after.get(key)
+            old_text = f"{old * scale:9.1f}" if old is not None else "      n/a"
+            new_text = f"{new * scale:9.1f}" if new is not None else "      n/a"
+            print(f"{key + ' (' + unit + ')':26} {old_text} -> {new_text} {change(old, new)}")
+        print(f"{'analytics modules':26} {', '.join(startup_before.get('analytics_modules', [])) or '-'}"
+              f" -> {', '.join(startup_after.get('analytics_modules', [])) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# benchmarks/run.py
+# Seeds a database and measures the API under concurrent load, fully offline by default:
+#   python -m benchmarks.run --interactions 100000 --requests 500 --concurrency 20
+# Without --database-url a fresh SQLite file is used; without --redis-url an in-memory
+# Redis stand-in (fakeredis) is started. Results are written as JSON, see compare.py.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+SCENARIOS = [
+    "submit",
+    "bulk_list",
+    "interactions_page",
+    "interactions_user",
+    "stats_usage",
+    "stats_interactions",
+    "stats_feedback",
+    "stats_timeseries",
+    "predict",
+    "predict_batch",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the interactions API")
+    parser.add_argument("--database-url", help="Defaults to a new SQLite file in a temporary directory")
+    parser.add_argument("--redis-url", help="Defaults to an in-memory Redis stand-in")
+    parser.add_argument("--interactions", type=int, default=10_000, help="Interactions to seed")
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--actions", type=int, default=30)
+    parser.add_argument("--skew", type=float, default=1.3, help="Zipf exponent of the user and action popularity")
+    parser.add_argument("--days", type=float, default=30, help="Time span covered by the seeded interactions")
+    parser.add_argument("--seed-chunk", type=int, default=50_000, help="Interactions per seeding request")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="Defaults to benchmarks/results/<commit>-<time>.json")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    return server, f"redis://{host}:{port}/0"
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+class Workload:
+    # Skewed users and actions: a few are very popular, most are rare
+    def __init__(self, args):
+        self.args = args
+        self.rng = np.random.default_rng(args.random_seed)
+        self.users = [f"user{index}" for index in range(args.users)]
+        self.actions = [f"action{index}" for index in range(args.actions)]
+
+    def _zipf(self, size, n):
+        return (self.rng.zipf(self.args.skew, size) - 1) % n
+
+    def user(self):
+        return self.users[self._zipf(1, len(self.users))[0]]
+
+    def action(self):
+        return self.actions[self._zipf(1, len(self.actions))[0]]
+
+    def seed_chunks(self):
+        # NDJSON bodies in time order, so the derived tables are maintained incrementally
+        total = self.args.interactions
+        start = datetime.now() - timedelta(days=self.args.days)
+        step = timedelta(days=self.args.days) / max(total, 1)
+        for offset in range(0, total, self.args.seed_chunk):
+            size = min(self.args.seed_chunk, total - offset)
+            users = self._zipf(size, len(self.users))
+            actions = self._zipf(size, len(self.actions))
+            yield "\n".join(
+                json.dumps({
+                    "username": self.users[user],
+                    "action": self.actions[action],
+                    "timestamp": (start + step * (offset + index)).isoformat(),
+                })
+                for index, (user, action) in enumerate(zip(users, actions))
+            )
+
+    def request(self, scenario):
+        # (method, path, keyword arguments for httpx)
+        if scenario == "submit":
+            return "POST", "/interactions/submit", {"json": {"action": self.action()}}
+        if scenario == "bulk_list":
+            events = [{"username": self.user(), "action": self.action()} for _ in range(100)]
+            return "POST", "/set/user-interactions/list", {"json": events}
+        if scenario == "interactions_page":
+            after_id = int(self.rng.integers(0, max(self.args.interactions, 1)))
+            return "GET", "/interactions", {"params": {"after_id": after_id, "limit": 1000}}
+        if scenario == "interactions_user":
+            return "GET", f"/interactions/{self.user()}", {"params": {"limit": 1000}}
+        if scenario == "stats_usage":
+            return "GET", "/stats/usage", {}
+        if scenario == "stats_interactions":
+            return "GET", "/stats/interactions", {}
+        if scenario == "stats_feedback":
+            return "GET", "/stats/feedback", {}
+        if scenario == "stats_timeseries":
+            until = datetime.now()
+            params = {"from": (until - timedelta(days=1)).isoformat(), "to": until.isoformat(), "granularity": "hour"}
+            return "GET", "/stats/timeseries", {"params": params}
+        if scenario == "predict":
+            return "GET", f"/predict_next_action/{self.user()}", {}
+        if scenario == "predict_batch":
+            return "POST", "/predict_next_action/batch", {"json": {"usernames": [self.user() for _ in range(100)], "k": 3}}
+        raise ValueError(f"Unknown scenario '{scenario}'")
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = np.asarray(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "mean": float(latencies.mean()) if count else None,
+        "p50": float(np.percentile(latencies, 50)) if count else None,
+        "p90": float(np.percentile(latencies, 90)) if count else None,
+        "p99": float(np.percentile(latencies, 99)) if count else None,
+        "max": float(latencies.max()) if count else None,
+    }
+
+
+async def run_scenario(client, workload, scenario, headers, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        method, path, kwargs = workload.request(scenario)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, path, headers=headers, **kwargs)
+            latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+# Scenarios served from the scheduler's precomputed results: endpoint path -> job name
+PRECOMPUTED = {
+    "stats_usage": ("/stats/usage", "usage_stats"),
+    "stats_interactions": ("/stats/interactions", "interactions_stats"),
+    "stats_feedback": ("/stats/feedback", "feedback_stats"),
+}
+
+
+async def wait_for_precomputed(client, headers, scenarios, timeout=600):
+    # The /stats/* endpoints answer 503 until the scheduler published a result: have each
+    # job run again on the seeded data, and wait for that result before measuring
+    from scheduler import scheduler
+
+    started = datetime.now()
+    for scenario in scenarios:
+        if scenario not in PRECOMPUTED:
+            continue
+        path, job = PRECOMPUTED[scenario]
+        await scheduler.run_now(job)
+        deadline = time.perf_counter() + timeout
+        while True:
+            response = await client.get(path, headers=headers)
+            if response.status_code == 200 and datetime.fromisoformat(response.json()["computed_at"]) >= started:
+                break
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"No result published for {path} after {timeout}s")
+            await asyncio.sleep(0.5)
+        print(f"{job} published", file=sys.stderr)
+
+
+async def benchmark(args, app, create_user):
+    import httpx
+
+    workload = Workload(args)
+    results = {}
+    async with app.router.lifespan_context(app):
+        # Application errors come back as 500 responses and are counted, not raised
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            password = secrets.token_urlsafe(16)
+            await asyncio.to_thread(create_user, "bench-admin", password, True)
+            response = await client.post("/login", json={"username": "bench-admin", "password": password})
+            response.raise_for_status()
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+            start = time.perf_counter()
+            seeded = 0
+            for body in workload.seed_chunks():
+                response = await client.post(
+                    "/set/user-interactions/list", content=body,
+                    headers={**headers, "Content-Type": "application/x-ndjson"},
+                )
+                response.raise_for_status()
+                seeded += response.json()["count"]
+            elapsed = time.perf_counter() - start
+            results["seed"] = {"rows": seeded, "seconds": elapsed, "rows_per_second": seeded / elapsed if elapsed else 0.0}
+            print(f"seeded {seeded} interactions in {elapsed:.1f}s", file=sys.stderr)
+
+            await wait_for_precomputed(client, headers, args.scenarios)
+
+            for scenario in args.scenarios:
+                results[scenario] = await run_scenario(
+                    client, workload, scenario, headers, args.requests, args.concurrency
+                )
+                summary = results[scenario]
+                print(
+                    f"{scenario:20} {summary['throughput']:9.1f} req/s  p50 {summary['p50'] * 1000:8.2f} ms"
+                    f"  p99 {summary['p99'] * 1000:8.2f} ms  errors {summary['errors']}",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="statsapi-bench-")
+    fake_redis = None
+    redis_url = args.redis_url
+    if redis_url is None:
+        fake_redis, redis_url = start_fake_redis()
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    # The application reads its configuration at import time
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["REDIS_URL"] = redis_url
+    os.environ.setdefault("FEEDBACK_MODEL_PATH", os.path.join(workdir, "feedback_model.joblib"))
+    from app import app
+    from interactions import create_user
+
+    try:
+        results = asyncio.run(benchmark(args, app, create_user))
+    finally:
+        if fake_redis is not None:
+            fake_redis.shutdown()
+            fake_redis.server_close()
+
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": database_url.split(":", 1)[0],
+        "redis": "fakeredis" if fake_redis is not None else "redis",
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key not in ("database_url", "redis_url", "output")
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), "results", f"{(commit or 'unknown')[:10]}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
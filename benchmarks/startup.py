@@ -0,0 +1,139 @@
+# benchmarks/startup.py
+# Measures the cold start and memory footprint of one API worker, each run in a fresh
+# interpreter:
+#   python -m benchmarks.startup --runs 5
+# Like run.py it needs no services (SQLite file, in-memory Redis stand-in) and writes a
+# JSON result file that compare.py understands.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.run import git_revision, start_fake_redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules of the analytics stack worth reporting when they end up in the API process
+ANALYTICS_MODULES = ["numpy", "scipy", "sklearn", "pandas", "pyarrow", "joblib"]
+
+# Runs in the measured interpreter: times `import app` and the startup hooks, then reads
+# the process' own memory before and after one feedback clustering
+WORKER = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+async def main():
+    from datetime import datetime, timedelta
+    from interactions import insert_interactions
+    from utils import compute_feedback_stats
+
+    async with app.app.router.lifespan_context(app.app):
+        ready = time.perf_counter()
+        result = {
+            "import_seconds": imported - started,
+            "startup_seconds": ready - imported,
+            "rss_mb": rss_mb(),
+        }
+        await asyncio.to_thread(insert_interactions, [
+            (f"user{index % 50}", f"action{index % 7}", datetime.now() - timedelta(seconds=index))
+            for index in range(int(sys.argv[1]))
+        ])
+        await compute_feedback_stats()
+        result["feedback_seconds"] = time.perf_counter() - ready
+        result["rss_after_feedback_mb"] = rss_mb()
+        result["analytics_modules"] = sorted(name for name in sys.argv[2:] if name in sys.modules)
+    print(json.dumps(result))
+
+asyncio.run(main())
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cold start and memory of an API worker")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to start")
+    parser.add_argument("--interactions", type=int, default=1_000, help="Interactions seeded before the feedback run")
+    parser.add_argument("--output", help="Defaults to benchmarks/results/<commit>-startup-<time>.json")
+    return parser.parse_args(argv)
+
+
+def measure(args, redis_url):
+    workdir = tempfile.mkdtemp(prefix="statsapi-startup-")
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        "REDIS_URL": redis_url,
+        "FEEDBACK_MODEL_PATH": os.path.join(workdir, "feedback_model.joblib"),
+        "PYTHONPATH": ROOT,
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER, str(args.interactions), *ANALYTICS_MODULES],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    summary = {}
+    for key in ("import_seconds", "startup_seconds", "rss_mb", "feedback_seconds", "rss_after_feedback_mb"):
+        values = [run[key] for run in runs if run.get(key) is not None]
+        summary[key] = float(np.median(values)) if values else None
+    summary["analytics_modules"] = runs[-1]["analytics_modules"] if runs else []
+    summary["runs"] = len(runs)
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake_redis, redis_url = start_fake_redis()
+    runs = []
+    try:
+        for index in range(args.runs):
+            run = measure(args, redis_url)
+            runs.append(run)
+            print(
+                f"run {index + 1}: import {run['import_seconds'] * 1000:7.1f} ms  startup {run['startup_seconds'] * 1000:7.1f} ms"
+                f"  rss {run['rss_mb']:6.1f} MB  after feedback {run['rss_after_feedback_mb']:6.1f} MB",
+                file=sys.stderr,
+            )
+    finally:
+        fake_redis.shutdown()
+        fake_redis.server_close()
+
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"runs": args.runs, "interactions": args.interactions},
+        "results": {"startup": summarize(runs)},
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), "results", f"{(commit or 'unknown')[:10]}-startup-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
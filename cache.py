@@ -0,0 +1,230 @@
+# cache.py
+import asyncio
+import gzip
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import orjson
+import redis.asyncio as redis
+
+from locks import redis_lock
+
+CACHE_PREFIX = "cache:"
+LOCK_PREFIX = "cache_lock:"
+TAG_PREFIX = "cache_tag:"
+
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "1024"))
+# How long a worker trusts its in-process copy before looking at Redis again
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "1"))
+# Lease of the recompute lock; a worker that dies mid-computation frees the key after this
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "120"))
+CACHE_POLL_INTERVAL = float(os.getenv("CACHE_POLL_INTERVAL", "0.05"))
+# Cached response bodies at least this large are stored gzip-compressed
+CACHE_GZIP_MIN_BYTES = int(os.getenv("CACHE_GZIP_MIN_BYTES", "1024"))
+
+# Per-endpoint lifetimes (seconds): fresh for *_TTL, then served stale for *_STALE_TTL
+# while one worker recomputes
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "2"))
+PREDICTION_CACHE_STALE_TTL = float(os.getenv("PREDICTION_CACHE_STALE_TTL", "10"))
+
+
+def dumps(value):
+    # Native encoder: datetimes and numpy scalars go straight to UTF-8 bytes
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def encode_body(value, gzip_min_bytes=CACHE_GZIP_MIN_BYTES):
+    # The response body as cached: (bytes, "gzip" or None)
+    body = dumps(value)
+    if len(body) >= gzip_min_bytes:
+        return gzip.compress(body, compresslevel=1), "gzip"
+    return body, None
+
+
+def pack(header, body):
+    # One Redis value: a JSON header line, then the body bytes untouched
+    return dumps(header) + b"\n" + body
+
+
+def unpack(raw):
+    header, _, body = raw.partition(b"\n")
+    return orjson.loads(header), body
+
+
+class StatsCache:
+    # Two tiers: a small in-process LRU in front of Redis. Entries stay readable for
+    # stale_ttl after they stop being fresh, and are served while a single worker
+    # (the holder of the Redis lock) recomputes them.
+    # Values are stored as ready-to-send JSON bytes (see encode_body) and handed back as
+    # (body, encoding), so a hit never decodes and re-encodes them. The Redis client must
+    # not decode responses.
+    # Entries can be tagged (e.g. "user:<name>"). Each tag has a generation counter in
+    # Redis and an entry remembers the generations it was computed under: bumping a tag
+    # invalidates every entry carrying it at once, without deleting or scanning keys.
+    def __init__(self, redis_client=None, local_max_entries=CACHE_LOCAL_MAX_ENTRIES,
+                 local_ttl=CACHE_LOCAL_TTL, lock_timeout=CACHE_LOCK_TIMEOUT):
+        self.redis = redis_client
+        self.local_max_entries = local_max_entries
+        self.local_ttl = local_ttl
+        self.lock_timeout = lock_timeout
+        # key -> ((body, encoding), fresh_until, stale_until, checked_until, generations)
+        self.local = OrderedDict()
+        # (key, generations) -> task recomputing it in this process
+        self.refreshing = {}
+        self.counters = {}
+        self.tag_invalidations = 0
+
+    def _count(self, name, outcome):
+        counters = self.counters.setdefault(
+            name, {"hits": 0, "local_hits": 0, "misses": 0, "stale": 0, "refreshes": 0, "errors": 0}
+        )
+        counters[outcome] += 1
+
+    def _remember(self, key, entry, generations):
+        value, fresh_until, stale_until = entry
+        checked_until = min(time.time() + self.local_ttl, fresh_until)
+        self.local[key] = (value, fresh_until, stale_until, checked_until, generations)
+        self.local.move_to_end(key)
+        while len(self.local) > self.local_max_entries:
+            self.local.popitem(last=False)
+
+    async def _generations(self, tags):
+        if not tags:
+            return {}
+        values = await self.redis.mget([TAG_PREFIX + tag for tag in tags])
+        return {tag: int(value or 0) for tag, value in zip(tags, values)}
+
+    async def _read(self, key, tags=()):
+        # Returns (entry, from_local, current generations of tags); entry is None when the
+        # key is missing or was computed before one of its tags was invalidated.
+        # Tagged entries cost one MGET per read, even from the local tier, so a worker
+        # never serves a copy invalidated by another one.
+        generations = await self._generations(tags)
+        cached = self.local.get(key)
+        if cached is not None and cached[3] > time.time() and cached[4] == generations:
+            self.local.move_to_end(key)
+            return cached[:3], True, generations
+        raw = await self.redis.get(CACHE_PREFIX + key)
+        if raw is None:
+            self.local.pop(key, None)
+            return None, False, generations
+        header, body = unpack(raw)
+        if header["generations"] != generations:
+            self.local.pop(key, None)
+            return None, False, generations
+        entry = ((body, header["encoding"]), header["fresh_until"], header["stale_until"])
+        self._remember(key, entry, generations)
+        return entry, False, generations
+
+    async def _write(self, key, value, ttl, stale_ttl, generations):
+        now = time.time()
+        body, encoding = encode_body(value)
+        entry = ((body, encoding), now + ttl, now + ttl + stale_ttl)
+        header = {"encoding": encoding, "fresh_until": entry[1], "stale_until": entry[2], "generations": generations}
+        await self.redis.set(CACHE_PREFIX + key, pack(header, body), ex=max(int(ttl + stale_ttl + 0.999), 1))
+        self._remember(key, entry, generations)
+        return entry
+
+    async def _refresh(self, name, key, compute, ttl, stale_ttl, generations):
+        # Recomputes key if this worker wins the lock. Returns the new entry, or None if
+        # another worker is already computing it. generations were read before compute
+        # runs, so a tag bumped meanwhile invalidates the result.
+        async with redis_lock(self.redis, LOCK_PREFIX + key, self.lock_timeout, wait=False) as acquired:
+            if not acquired:
+                return None
+            self._count(name, "refreshes")
+            return await self._write(key, await compute(), ttl, stale_ttl, generations)
+
+    def _refresh_once(self, name, key, compute, ttl, stale_ttl, generations):
+        # Concurrent callers in this process share one refresh task, unless a tag was
+        # invalidated after it started
+        refresh_id = (key, tuple(sorted(generations.items())))
+        task = self.refreshing.get(refresh_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh(name, key, compute, ttl, stale_ttl, generations))
+            self.refreshing[refresh_id] = task
+            task.add_done_callback(lambda _: self.refreshing.pop(refresh_id, None))
+        return task
+
+    async def _wait_for_value(self, name, key, compute, ttl, stale_ttl, tags, generations):
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            entry = await asyncio.shield(self._refresh_once(name, key, compute, ttl, stale_ttl, generations))
+            if entry is not None:
+                return entry
+            # Another worker holds the lock: poll for its result until the lease runs out
+            await asyncio.sleep(CACHE_POLL_INTERVAL)
+            entry, _, generations = await self._read(key, tags)
+            if entry is not None:
+                return entry
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for cache key {key}")
+
+    def _refresh_in_background(self, name, key, compute, ttl, stale_ttl, generations):
+        if any(refresh_id[0] == key for refresh_id in self.refreshing):
+            return
+
+        def log_failure(task):
+            if not task.cancelled() and task.exception() is not None:
+                self._count(name, "errors")
+                logging.error(f"Background refresh of {key} failed: {task.exception()}")
+
+        self._refresh_once(name, key, compute, ttl, stale_ttl, generations).add_done_callback(log_failure)
+
+    async def get_or_compute(self, key, compute, ttl, stale_ttl=0, name=None, tags=()):
+        # compute: coroutine function returning a JSON-serializable value. Returns the
+        # encoded (body, encoding), see encode_body.
+        # name groups the counters of keys built from the same template (e.g. per user).
+        # tags: the entry is dropped as soon as invalidate_tags is called with one of them.
+        name = name or key
+        if self.redis is None:
+            self._count(name, "misses")
+            return encode_body(await compute())
+        try:
+            entry, local, generations = await self._read(key, tags)
+            now = time.time()
+            if entry is not None and entry[1] > now:
+                self._count(name, "local_hits" if local else "hits")
+                return entry[0]
+            if entry is not None and entry[2] > now:
+                self._count(name, "stale")
+                self._refresh_in_background(name, key, compute, ttl, stale_ttl, generations)
+                return entry[0]
+            self._count(name, "misses")
+            return (await self._wait_for_value(name, key, compute, ttl, stale_ttl, tags, generations))[0]
+        except redis.RedisError as e:
+            self._count(name, "errors")
+            logging.error(f"Redis error on cache key {key}: {e}")
+            return encode_body(await compute())
+
+    async def invalidate_tags(self, *tags):
+        # One pipelined INCR per tag; entries computed under an older generation are
+        # ignored from their next read on
+        if self.redis is None or not tags:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.incr(TAG_PREFIX + tag)
+            await pipe.execute()
+        self.tag_invalidations += len(tags)
+
+    def stats(self):
+        return {
+            "local_entries": len(self.local),
+            "local_max_entries": self.local_max_entries,
+            "refreshing": len(self.refreshing),
+            "tag_invalidations": self.tag_invalidations,
+            "keys": {
+                name: {
+                    **counters,
+                    "hit_ratio": (counters["hits"] + counters["local_hits"] + counters["stale"])
+                    / max(sum(counters[outcome] for outcome in ("hits", "local_hits", "misses", "stale")), 1),
+                }
+                for name, counters in sorted(self.counters.items())
+            },
+        }
+
+
+stats_cache = StatsCache()
@@ -0,0 +1,39 @@
+# hashing.py
+import os
+
+import bcrypt
+
+from process_pool import BoundedProcessPool
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", "2"))
+# Jobs allowed to wait for a free worker; beyond that requests are rejected immediately
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "32"))
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+# Worker-side functions: top level so they can be pickled
+def _hash_password(password: bytes, rounds: int):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed: bytes):
+    return bcrypt.checkpw(password, hashed)
+
+
+hash_pool = BoundedProcessPool(
+    "Password hashing", HASH_POOL_SIZE, HASH_QUEUE_SIZE, HashPoolBusy,
+    run_label="hash", info={"bcrypt_rounds": BCRYPT_ROUNDS},
+)
+
+
+async def hash_password(password: str) -> str:
+    hashed = await hash_pool.run(_hash_password, password.encode('utf-8'), BCRYPT_ROUNDS)
+    return hashed.decode('utf-8')
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    return await hash_pool.run(_check_password, password.encode('utf-8'), hashed.encode('utf-8'))
@@ -0,0 +1,204 @@
+# ingestion.py
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from interactions import InteractionEvent, StrictClock, events_to_rows, insert_interactions_async
+
+# "sync" keeps one INSERT per request, "batched" enables the write-behind queue
+INGESTION_MODE = os.getenv("INGESTION_MODE", "sync")
+INGESTION_QUEUE_MAX_SIZE = int(os.getenv("INGESTION_QUEUE_MAX_SIZE", "10000"))
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "500"))
+INGESTION_FLUSH_INTERVAL = float(os.getenv("INGESTION_FLUSH_INTERVAL", "0.5"))
+INGESTION_ENQUEUE_TIMEOUT = float(os.getenv("INGESTION_ENQUEUE_TIMEOUT", "0.05"))
+# A failed flush is retried this many times, waiting INGESTION_RETRY_BACKOFF seconds and
+# doubling each time; the batch is then appended to the dead-letter file (NDJSON, the
+# format accepted by /set/user-interactions/list) so it can be replayed
+INGESTION_FLUSH_RETRIES = int(os.getenv("INGESTION_FLUSH_RETRIES", "5"))
+INGESTION_RETRY_BACKOFF = float(os.getenv("INGESTION_RETRY_BACKOFF", "0.5"))
+INGESTION_DEAD_LETTER_PATH = os.getenv("INGESTION_DEAD_LETTER_PATH", "ingestion_dead_letter.ndjson")
+# Rows per transaction when backfilling from an NDJSON stream
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "5000"))
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+class IngestionPipeline:
+    def __init__(self, max_size=INGESTION_QUEUE_MAX_SIZE, batch_size=INGESTION_BATCH_SIZE,
+                 flush_interval=INGESTION_FLUSH_INTERVAL, enqueue_timeout=INGESTION_ENQUEUE_TIMEOUT,
+                 flush_retries=INGESTION_FLUSH_RETRIES, retry_backoff=INGESTION_RETRY_BACKOFF,
+                 dead_letter_path=INGESTION_DEAD_LETTER_PATH, on_flush=None):
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.flush_retries = flush_retries
+        self.retry_backoff = retry_backoff
+        self.dead_letter_path = dead_letter_path
+        # coroutine called with the flushed rows once they are committed
+        self.on_flush = on_flush
+        self._task = None
+        self._stopping = False
+        self.counters = {
+            "accepted": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "retries": 0,
+            "dead_lettered": 0,
+            "failed": 0,
+            "flushes": 0,
+            "flush_seconds_total": 0.0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+        }
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Let the flusher drain everything still queued, then wait for it
+        self._stopping = True
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def submit(self, username: str, action: str):
+        if self._stopping:
+            raise IngestionQueueFull("Ingestion pipeline is shutting down")
+        item = (username, action, datetime.now())
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(item), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.counters["rejected"] += 1
+                raise IngestionQueueFull("Ingestion queue is full")
+        self.counters["accepted"] += 1
+
+    async def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+            # Drain whatever is already waiting without yielding to the timer
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while not (self._stopping and self.queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+
+    def _write_dead_letter(self, batch):
+        with open(self.dead_letter_path, "a") as f:
+            for username, action, timestamp in batch:
+                f.write(json.dumps({"username": username, "action": action, "timestamp": timestamp.isoformat()}) + "\n")
+
+    async def _dead_letter(self, batch):
+        # Last resort once the retries are exhausted: the clients were already answered, so
+        # the events must outlive this process
+        try:
+            await asyncio.to_thread(self._write_dead_letter, batch)
+        except Exception as e:
+            self.counters["failed"] += len(batch)
+            logging.error(f"Ingestion lost {len(batch)} interactions, dead-letter write failed: {e}")
+            return
+        self.counters["dead_lettered"] += len(batch)
+        logging.error(f"Ingestion wrote {len(batch)} interactions to {self.dead_letter_path}")
+
+    async def _flush(self, batch):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                await insert_interactions_async(batch, server_timestamps=True)
+                break
+            except Exception as e:
+                logging.error(f"Ingestion flush of {len(batch)} interactions failed (attempt {attempt + 1}): {e}")
+                if attempt >= self.flush_retries:
+                    await self._dead_letter(batch)
+                    return
+            # The queue keeps filling meanwhile and turns clients away with 503 once full
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+            self.counters["retries"] += 1
+        elapsed = time.perf_counter() - start
+        self.counters["flushed"] += len(batch)
+        self.counters["flushes"] += 1
+        self.counters["flush_seconds_total"] += elapsed
+        self.counters["last_flush_seconds"] = elapsed
+        self.counters["max_flush_seconds"] = max(self.counters["max_flush_seconds"], elapsed)
+        if self.on_flush is not None:
+            try:
+                await self.on_flush(batch)
+            except Exception as e:
+                logging.error(f"Ingestion post-flush hook failed: {e}")
+
+    def stats(self):
+        flushes = self.counters["flushes"]
+        return {
+            "mode": "batched",
+            "queue_depth": self.queue.qsize(),
+            "queue_max_size": self.max_size,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "dead_letter_path": self.dead_letter_path,
+            **self.counters,
+            "avg_flush_seconds": self.counters["flush_seconds_total"] / flushes if flushes else 0.0,
+        }
+
+
+async def iter_ndjson_rows(stream, default_username=None, chunk_size=BULK_CHUNK_SIZE):
+    # Parses an NDJSON byte stream line by line and yields lists of at most chunk_size rows
+    clock = StrictClock()
+    buffer = b""
+    events = []
+    line_number = 0
+
+    def parse(line):
+        nonlocal line_number
+        line_number += 1
+        line = line.strip()
+        if line:
+            try:
+                events.append(InteractionEvent(**json.loads(line)))
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Invalid event on line {line_number}: {e}")
+
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            parse(line)
+            if len(events) >= chunk_size:
+                yield events_to_rows(events, default_username, clock)
+                events.clear()
+    parse(buffer)
+    if events:
+        yield events_to_rows(events, default_username, clock)
+
+
+async def ingest_ndjson(stream, default_username=None, chunk_size=BULK_CHUNK_SIZE, on_rows=None):
+    # on_rows: optional coroutine function called with each committed chunk
+    total = 0
+    async for rows in iter_ndjson_rows(stream, default_username, chunk_size):
+        total += await insert_interactions_async(rows)
+        if on_rows is not None:
+            await on_rows(rows)
+    return total
@@ -1,26 +1,129 @@
 # interactions.py
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, UUID, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, UUID, Index, ForeignKey, create_engine, event, insert, select, delete, func, literal, case, union_all
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, scoped_session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.engine import make_url
 from sqlalchemy.pool import NullPool
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import BaseModel, Field
+from datetime import datetime, timedelta
 import os
 import bcrypt
-from typing import Optional
+from hashing import BCRYPT_ROUNDS, hash_password, check_password
+from analytics import ANALYTICS_POOL_SIZE
+from metrics import instrument_engine
+from typing import List, Optional
 import logging
 
 Base = declarative_base()
 
+class Action(Base):
+    # Dictionary of action names: every other table stores the small integer id
+    __tablename__ = 'actions'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+
 class Interaction(Base):
     __tablename__ = 'interactions'
     id = Column(Integer, primary_key=True, index=True)  
     username = Column(String)
-    action = Column(String)
+    action_id = Column(Integer, ForeignKey("actions.id"))
+    timestamp = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_interactions_username_timestamp", "username", "timestamp"),
+        Index("ix_interactions_action_id", "action_id"),
+    )
+
+
+class ActionTransition(Base):
+    # Per-user first-order Markov counts: how often to_action followed from_action
+    __tablename__ = 'action_transitions'
+    username = Column(String, primary_key=True)
+    from_action_id = Column(Integer, primary_key=True)
+    to_action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ActionTrigram(Base):
+    # Second-order counts: how often to_action followed the pair (before_action, from_action).
+    # Only maintained when PREDICTION_MARKOV_ORDER is 2.
+    __tablename__ = 'action_trigrams'
+    username = Column(String, primary_key=True)
+    before_action_id = Column(Integer, primary_key=True)
+    from_action_id = Column(Integer, primary_key=True)
+    to_action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class UserLastAction(Base):
+    __tablename__ = 'user_last_actions'
+    username = Column(String, primary_key=True)
+    action_id = Column(Integer)
+    # The action before the last one, the context of the trigram counts
+    previous_action_id = Column(Integer)
     timestamp = Column(DateTime)
 
 
+class ActionRollup(Base):
+    # Interactions per action per time bucket, one row per (granularity, bucket, action)
+    __tablename__ = 'action_rollups'
+    granularity = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class UserRollup(Base):
+    __tablename__ = 'user_rollups'
+    granularity = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    username = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# What is left of interactions once the retention job removed them from the hot table
+class ArchivedInteractionCount(Base):
+    __tablename__ = 'archived_interaction_counts'
+    day = Column(DateTime, primary_key=True)
+    username = Column(String, primary_key=True)
+    action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedTransition(Base):
+    # Transitions whose target event was archived; the live counts keep including them,
+    # these only let a rebuild from the hot table start from the right totals
+    __tablename__ = 'archived_transitions'
+    username = Column(String, primary_key=True)
+    from_action_id = Column(Integer, primary_key=True)
+    to_action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedTrigram(Base):
+    __tablename__ = 'archived_trigrams'
+    username = Column(String, primary_key=True)
+    before_action_id = Column(Integer, primary_key=True)
+    from_action_id = Column(Integer, primary_key=True)
+    to_action_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedLastAction(Base):
+    # Per user: the last two archived actions, where the hot history picks up, and how
+    # many interactions were archived
+    __tablename__ = 'archived_last_actions'
+    username = Column(String, primary_key=True)
+    action_id = Column(Integer)
+    previous_action_id = Column(Integer)
+    timestamp = Column(DateTime)
+    interaction_count = Column(Integer, nullable=False, default=0)
+
+
 class User(Base):
     __tablename__ = 'users'
     username = Column(String, primary_key=True, index=True)
@@ -55,17 +158,101 @@ class InteractionsList(BaseModel):
     interactions: str
     username: str
 
+class InteractionEvent(BaseModel):
+    action: str
+    username: Optional[str] = None
+    timestamp: Optional[datetime] = None
+
+PREDICTION_MAX_K = int(os.getenv("PREDICTION_MAX_K", "20"))
+
+class PredictionBatchRequest(BaseModel):
+    # Either an explicit list of users, or every user active since the given time
+    usernames: Optional[List[str]] = None
+    since: Optional[datetime] = None
+    k: int = Field(3, ge=1, le=PREDICTION_MAX_K)
+
+ROLLUP_GRANULARITIES = [
+    granularity.strip()
+    for granularity in os.getenv("ROLLUP_GRANULARITIES", "minute,hour,day").split(",")
+    if granularity.strip()
+]
+# "false" leaves the rollups to the compaction command (manage.py compact-rollups)
+ROLLUP_ON_INGEST = os.getenv("ROLLUP_ON_INGEST", "true").lower() == "true"
+# 2 also maintains trigram counts on ingest; after switching from 1, run
+# manage.py rebuild-transitions to backfill them
+PREDICTION_MARKOV_ORDER = int(os.getenv("PREDICTION_MARKOV_ORDER", "1"))
+# Events this much older than a user's last one are taken as concurrent arrivals, not backfills
+INGEST_REORDER_WINDOW = timedelta(seconds=float(os.getenv("INGEST_REORDER_WINDOW", "5")))
+
+# Async engine: serves the API
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "0"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+# asyncpg prepared statements kept per connection, and SQLAlchemy compiled statements per engine
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "500"))
+# Sync engine: migrations, maintenance commands and the CPU-bound analytics threads
+DB_SYNC_POOL_SIZE = int(os.getenv("DB_SYNC_POOL_SIZE", "5"))
+# Worker processes serving the API (uvicorn reads the same variable for --workers)
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+# Connections all workers may hold together; keep it under Postgres' max_connections
+# (100 by default). Each worker shrinks its pools to its share, 0 disables the cap.
+# The share includes the worker's analytics processes: each imports this module and runs
+# one job at a time on its own sync engine, so it holds one connection.
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "80"))
+
+def _pool_sizes():
+    # (async pool size, async overflow, sync pool size) of one worker
+    pool_size, max_overflow, sync_pool_size = DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_SYNC_POOL_SIZE
+    if DB_MAX_CONNECTIONS:
+        share = max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY - ANALYTICS_POOL_SIZE, 2)
+        sync_pool_size = max(min(sync_pool_size, share // 4), 1)
+        max_overflow = max(min(max_overflow, share - sync_pool_size - 1), 0)
+        pool_size = max(min(pool_size, share - sync_pool_size - max_overflow), 1)
+    return pool_size, max_overflow, sync_pool_size
+
+POOL_SIZE, POOL_MAX_OVERFLOW, SYNC_POOL_SIZE = _pool_sizes()
+
 def get_database_url():
     db_url = os.getenv("DATABASE_URL")
     if not db_url:
         raise ValueError("DATABASE_URL environment variable not set")
     return db_url
 
+def get_async_database_url():
+    url = make_url(get_database_url())
+    if url.get_backend_name() == "postgresql":
+        return url.set(drivername="postgresql+asyncpg")
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+def _async_engine_options(url):
+    if url.get_backend_name() == "sqlite":
+        # aiosqlite opens a connection per checkout, there is no pool to size
+        return {}
+    options = {
+        "pool_size": POOL_SIZE,
+        "max_overflow": POOL_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    if url.get_dialect().driver == "asyncpg":
+        options["connect_args"] = {
+            "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "command_timeout": DB_COMMAND_TIMEOUT,
+        }
+    return options
+
 engine = create_engine(
     get_database_url(),
     pool_pre_ping=True,      
-    pool_size=20,             
+    pool_size=SYNC_POOL_SIZE,             
     max_overflow=0,           
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    query_cache_size=DB_QUERY_CACHE_SIZE,
 )
 
 SessionLocal = sessionmaker(
@@ -77,18 +264,404 @@ SessionLocal = sessionmaker(
 def get_session() -> Session:
     return SessionLocal()
 
+_async_url = get_async_database_url()
+async_engine = create_async_engine(
+    _async_url,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    query_cache_size=DB_QUERY_CACHE_SIZE,
+    **_async_engine_options(_async_url),
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+def get_async_session() -> AsyncSession:
+    return AsyncSessionLocal()
+
+def _configure_sqlite(engine):
+    # SQLite is the development and benchmark stand-in: WAL lets readers and the single
+    # writer proceed concurrently, and writers queue on the lock instead of failing at once
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(DB_POOL_TIMEOUT * 1000)}")
+        cursor.close()
+
+_configure_sqlite(engine)
+_configure_sqlite(async_engine.sync_engine)
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # Schema changes go through the versioned migrations instead of a bare create_all
+    from migrations import migrate
+    migrate(engine)
 
-def insert_interaction(username: str, interaction: InteractionCreate):
+def _dialect_insert(db, model):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+def _upsert_counts(db, model, key_columns, counts):
+    if not counts:
+        return
+    stmt = _dialect_insert(db, model)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={"count": model.count + stmt.excluded.count},
+        ),
+        [dict(zip(key_columns, key), count=count) for key, count in sorted(counts.items())],
+    )
+
+# In-process caches of the actions dictionary. Ids are never reassigned, so entries never
+# go stale; only ids read back from committed rows are cached.
+_action_ids = {}
+_action_names = {}
+
+def _cache_actions(pairs):
+    for action_id, name in pairs:
+        _action_ids[name] = action_id
+        _action_names[action_id] = name
+
+def get_action_ids(db, names, create=True):
+    # name -> id for the given action names; unknown names are added to the dictionary
+    # when create is set, and left out of the result otherwise
+    missing = {name for name in names if name not in _action_ids}
+    if missing:
+        _cache_actions(db.execute(select(Action.id, Action.name).where(Action.name.in_(missing))).all())
+    ids = {name: _action_ids[name] for name in names if name in _action_ids}
+    missing = {name for name in names if name not in ids}
+    if missing and create:
+        db.execute(
+            _dialect_insert(db, Action).on_conflict_do_nothing(index_elements=["name"]),
+            [{"name": name} for name in sorted(missing)],
+        )
+        # Not cached yet: the new ids only become valid if the caller's transaction commits
+        ids.update(
+            (name, action_id)
+            for action_id, name in db.execute(select(Action.id, Action.name).where(Action.name.in_(missing)))
+        )
+    return ids
+
+def get_action_names(db, action_ids):
+    # id -> name, used to decode results at the API edge
+    missing = {action_id for action_id in action_ids if action_id is not None and action_id not in _action_names}
+    if missing:
+        _cache_actions(db.execute(select(Action.id, Action.name).where(Action.id.in_(missing))).all())
+    return {action_id: _action_names.get(action_id) for action_id in action_ids}
+
+def _lock_last_actions(db, usernames):
+    # Locks the users' user_last_actions rows for the rest of the caller's transaction
+    usernames = sorted(usernames)
+    # Make sure every user has a row to lock, so concurrent writers for a new user serialize
+    db.execute(
+        _dialect_insert(db, UserLastAction).on_conflict_do_nothing(index_elements=["username"]),
+        [{"username": username, "action_id": None, "previous_action_id": None, "timestamp": None}
+         for username in usernames],
+    )
+    return {
+        last.username: last
+        for last in db.scalars(
+            select(UserLastAction)
+            .where(UserLastAction.username.in_(usernames))
+            .order_by(UserLastAction.username)
+            .with_for_update()
+        )
+    }
+
+def _clamp_timestamps(rows, last_actions):
+    # Timestamps the server takes on receipt are taken before the lock, so concurrent
+    # requests for one user can commit out of order by a few milliseconds. Events at most
+    # INGEST_REORDER_WINDOW older than the user's last one are moved up to it; only older
+    # ones are backfills needing a recount. Never applied to client-supplied timestamps.
+    clamped = []
+    for username, action, timestamp in rows:
+        last = last_actions[username].timestamp
+        if last is not None and last - INGEST_REORDER_WINDOW <= timestamp < last:
+            timestamp = last
+        clamped.append((username, action, timestamp))
+    return clamped
+
+def _update_transitions(db, rows, last_actions=None):
+    # Keeps action_transitions / user_last_actions in step with freshly inserted rows,
+    # inside the caller's transaction; rows carry action ids
+    by_user = {}
+    for username, action, timestamp in rows:
+        by_user.setdefault(username, []).append((timestamp, action))
+    usernames = sorted(by_user)
+    if last_actions is None:
+        last_actions = _lock_last_actions(db, usernames)
+
+    counts = {}
+    trigram_counts = {}
+    for username in usernames:
+        events = sorted(by_user[username], key=lambda event: event[0])
+        last = last_actions[username]
+        if last.timestamp is not None and events[0][0] < last.timestamp:
+            # Backfilled events land in the middle of the history: recount this user
+            _rebuild_transitions(db, username)
+            continue
+        before, previous = last.previous_action_id, last.action_id
+        for _, action in events:
+            if previous is not None:
+                key = (username, previous, action)
+                counts[key] = counts.get(key, 0) + 1
+                if before is not None and PREDICTION_MARKOV_ORDER >= 2:
+                    key = (username, before, previous, action)
+                    trigram_counts[key] = trigram_counts.get(key, 0) + 1
+            before, previous = previous, action
+        last.timestamp = events[-1][0]
+        last.previous_action_id, last.action_id = before, previous
+
+    _upsert_counts(db, ActionTransition, ["username", "from_action_id", "to_action_id"], counts)
+    _upsert_counts(
+        db, ActionTrigram, ["username", "before_action_id", "from_action_id", "to_action_id"], trigram_counts
+    )
+
+def truncate_timestamp(timestamp, granularity):
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown granularity '{granularity}'")
+
+BUCKET_WIDTHS = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+def _update_rollups(db, rows):
+    action_counts = {}
+    user_counts = {}
+    for username, action, timestamp in rows:
+        for granularity in ROLLUP_GRANULARITIES:
+            bucket = truncate_timestamp(timestamp, granularity)
+            action_key = (granularity, bucket, action)
+            action_counts[action_key] = action_counts.get(action_key, 0) + 1
+            user_key = (granularity, bucket, username)
+            user_counts[user_key] = user_counts.get(user_key, 0) + 1
+    _upsert_counts(db, ActionRollup, ["granularity", "bucket", "action_id"], action_counts)
+    _upsert_counts(db, UserRollup, ["granularity", "bucket", "username"], user_counts)
+
+def _update_derived(db, rows, last_actions=None):
+    # Everything maintained alongside the raw rows, in the same transaction.
+    # rows: (username, action_id, timestamp)
+    _update_transitions(db, rows, last_actions)
+    if ROLLUP_ON_INGEST:
+        _update_rollups(db, rows)
+
+def _bucket_expression(db, column, granularity):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return func.date_trunc(granularity, column)
+    if dialect == "sqlite":
+        # Same text layout SQLAlchemy uses to store DateTime values on SQLite
+        formats = {
+            "minute": "%Y-%m-%d %H:%M:00.000000",
+            "hour": "%Y-%m-%d %H:00:00.000000",
+            "day": "%Y-%m-%d 00:00:00.000000",
+        }
+        return func.strftime(formats[granularity], column)
+    raise NotImplementedError(f"Rollup compaction is not supported on {dialect}")
+
+def _archive_horizon(db):
+    # Timestamp of the newest archived interaction: everything older left the hot table
+    return db.scalar(select(func.max(ArchivedLastAction.timestamp)))
+
+def _compact_rollups(db, since, until):
+    horizon = _archive_horizon(db)
+    for granularity in ROLLUP_GRANULARITIES:
+        # Widen the range to whole buckets so no bucket is recomputed from part of its events
+        start = truncate_timestamp(since, granularity)
+        end = truncate_timestamp(until, granularity)
+        if end < until:
+            end += BUCKET_WIDTHS[granularity]
+        if horizon is not None:
+            # Buckets holding archived events cannot be recounted from the hot table: keep them
+            start = max(start, truncate_timestamp(horizon, granularity) + BUCKET_WIDTHS[granularity])
+            if start >= end:
+                continue
+        in_range = (Interaction.timestamp >= start) & (Interaction.timestamp < end)
+        bucket = _bucket_expression(db, Interaction.timestamp, granularity)
+        for model, key, column in (
+            (ActionRollup, "action_id", Interaction.action_id),
+            (UserRollup, "username", Interaction.username),
+        ):
+            db.execute(
+                delete(model).where(
+                    model.granularity == granularity,
+                    model.bucket >= start,
+                    model.bucket < end,
+                )
+            )
+            db.execute(
+                insert(model).from_select(
+                    ["granularity", "bucket", key, "count"],
+                    select(literal(granularity), bucket, column, func.count())
+                    .where(in_range)
+                    .group_by(bucket, column),
+                )
+            )
+
+def compact_rollups(since: datetime, until: datetime):
+    # Recomputes every bucket overlapping [since, until) from the raw interactions
     db = get_session()
     try:
-        db_interaction = Interaction(
-            username=username,
-            action=interaction.action,
-            timestamp=datetime.now()
+        _compact_rollups(db, since, until)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Error compacting rollups: {e}")
+        raise
+    finally:
+        db.close()
+
+def _rebuild_transitions(db, username=None, usernames=None):
+    # One user, a collection of users, or (neither given) everyone
+    # Recounts from the hot table, on top of what the retention job archived. Reads the
+    # current schema, archive tables included: migrations must not call it.
+    transitions = delete(ActionTransition)
+    trigrams = delete(ActionTrigram)
+    last_actions = delete(UserLastAction)
+    interactions = select(Interaction.username, Interaction.action_id, Interaction.timestamp, Interaction.id)
+    archived_transitions = select(
+        ArchivedTransition.username, ArchivedTransition.from_action_id, ArchivedTransition.to_action_id,
+        ArchivedTransition.count
+    )
+    archived_trigrams = select(
+        ArchivedTrigram.username, ArchivedTrigram.before_action_id, ArchivedTrigram.from_action_id,
+        ArchivedTrigram.to_action_id, ArchivedTrigram.count
+    )
+    archived_last_actions = select(
+        ArchivedLastAction.username, ArchivedLastAction.action_id, ArchivedLastAction.previous_action_id,
+        ArchivedLastAction.timestamp
+    ).where(ArchivedLastAction.action_id.is_not(None))
+    if username is not None:
+        usernames = [username]
+    if usernames is not None:
+        usernames = sorted(usernames)
+        transitions = transitions.where(ActionTransition.username.in_(usernames))
+        trigrams = trigrams.where(ActionTrigram.username.in_(usernames))
+        last_actions = last_actions.where(UserLastAction.username.in_(usernames))
+        interactions = interactions.where(Interaction.username.in_(usernames))
+        archived_transitions = archived_transitions.where(ArchivedTransition.username.in_(usernames))
+        archived_trigrams = archived_trigrams.where(ArchivedTrigram.username.in_(usernames))
+        archived_last_actions = archived_last_actions.where(ArchivedLastAction.username.in_(usernames))
+    db.execute(transitions)
+    db.execute(trigrams)
+    db.execute(last_actions)
+    db.flush()
+
+    history = interactions.subquery()
+    in_order = (history.c.timestamp, history.c.id)
+    ordered = select(
+        history.c.username,
+        history.c.action_id,
+        history.c.timestamp,
+        func.lag(history.c.action_id).over(
+            partition_by=history.c.username, order_by=in_order
+        ).label("previous_action"),
+        func.lag(history.c.action_id, 2).over(
+            partition_by=history.c.username, order_by=in_order
+        ).label("before_action"),
+        func.row_number().over(
+            partition_by=history.c.username, order_by=in_order
+        ).label("position"),
+        func.row_number().over(
+            partition_by=history.c.username, order_by=(history.c.timestamp.desc(), history.c.id.desc())
+        ).label("position_from_end"),
+    ).subquery()
+    # The first hot events of a user follow their last archived ones
+    seed = archived_last_actions.subquery()
+    linked = select(
+        ordered.c.username,
+        ordered.c.action_id,
+        ordered.c.timestamp,
+        func.coalesce(ordered.c.previous_action, seed.c.action_id).label("previous_action"),
+        func.coalesce(
+            ordered.c.before_action,
+            case((ordered.c.position == 2, seed.c.action_id), else_=seed.c.previous_action_id),
+        ).label("before_action"),
+        ordered.c.position_from_end,
+    ).select_from(ordered.outerjoin(seed, seed.c.username == ordered.c.username)).subquery()
+
+    hot_transitions = (
+        select(linked.c.username, linked.c.previous_action, linked.c.action_id, func.count().label("count"))
+        .where(linked.c.previous_action.is_not(None))
+        .group_by(linked.c.username, linked.c.previous_action, linked.c.action_id)
+    )
+    combined = union_all(hot_transitions, archived_transitions).subquery()
+    keys = [combined.c[index] for index in range(3)]
+    db.execute(
+        insert(ActionTransition).from_select(
+            ["username", "from_action_id", "to_action_id", "count"],
+            select(*keys, func.sum(combined.c[3])).group_by(*keys),
         )
+    )
+    if PREDICTION_MARKOV_ORDER >= 2:
+        hot_trigrams = (
+            select(
+                linked.c.username, linked.c.before_action, linked.c.previous_action,
+                linked.c.action_id, func.count().label("count")
+            )
+            .where(linked.c.before_action.is_not(None))
+            .group_by(linked.c.username, linked.c.before_action, linked.c.previous_action, linked.c.action_id)
+        )
+        combined = union_all(hot_trigrams, archived_trigrams).subquery()
+        keys = [combined.c[index] for index in range(4)]
+        db.execute(
+            insert(ActionTrigram).from_select(
+                ["username", "before_action_id", "from_action_id", "to_action_id", "count"],
+                select(*keys, func.sum(combined.c[4])).group_by(*keys),
+            )
+        )
+    # Users with hot events end there, the others where their archive ends
+    hot_last_actions = select(
+        linked.c.username, linked.c.action_id, linked.c.previous_action, linked.c.timestamp
+    ).where(linked.c.position_from_end == 1)
+    db.execute(
+        insert(UserLastAction).from_select(
+            ["username", "action_id", "previous_action_id", "timestamp"],
+            union_all(
+                hot_last_actions,
+                archived_last_actions.where(ArchivedLastAction.username.not_in(select(history.c.username))),
+            ),
+        )
+    )
+
+def rebuild_transitions(username: str = None):
+    db = get_session()
+    try:
+        _rebuild_transitions(db, username)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Error rebuilding transitions: {e}")
+        raise
+    finally:
+        db.close()
+
+def insert_interaction(username: str, interaction: InteractionCreate):
+    db = get_session()
+    try:
+        last_actions = _lock_last_actions(db, [username])
+        action_id = get_action_ids(db, [interaction.action])[interaction.action]
+        [(_, _, timestamp)] = _clamp_timestamps([(username, action_id, datetime.now())], last_actions)
+        db_interaction = Interaction(username=username, action_id=action_id, timestamp=timestamp)
         db.add(db_interaction)
+        db.flush()
+        _update_derived(db, [(username, action_id, timestamp)], last_actions)
         db.commit()
         db.refresh(db_interaction)
         return db_interaction
@@ -98,17 +671,155 @@ def insert_interaction(username: str, interaction: InteractionCreate):
     finally:
         db.close()
 
-def get_all_interactions():
+def _insert_rows(db, rows, server_timestamps=False):
+    # rows carry action names; everything below this point works on ids.
+    # server_timestamps: the timestamps were taken by the server on receipt and may be
+    # clamped; client-supplied ones are stored as given, older ones being backfills
+    action_ids = get_action_ids(db, {action for _, action, _ in rows})
+    rows = [(username, action_ids[action], timestamp) for username, action, timestamp in rows]
+    last_actions = _lock_last_actions(db, {username for username, _, _ in rows})
+    if server_timestamps:
+        rows = _clamp_timestamps(rows, last_actions)
+    db.execute(insert(Interaction), [
+        {"username": username, "action_id": action_id, "timestamp": timestamp}
+        for username, action_id, timestamp in rows
+    ])
+    _update_derived(db, rows, last_actions)
+    return len(rows)
+
+def insert_interactions(rows, server_timestamps=False):
+    # rows: iterable of (username, action, timestamp), written as one multi-row INSERT
+    rows = list(rows)
+    if not rows:
+        return 0
     db = get_session()
     try:
-        interactions = db.query(Interaction).all()
-        return list(interactions)
+        count = _insert_rows(db, rows, server_timestamps)
+        db.commit()
+        return count
     except Exception as e:
-        logging.error(f"Error retrieving all interactions: {e}")
+        db.rollback()
+        logging.error(f"Error inserting {len(rows)} interactions: {e}")
+        raise
+    finally:
+        db.close()
+
+async def insert_interactions_async(rows, server_timestamps=False):
+    rows = list(rows)
+    if not rows:
+        return 0
+    async with get_async_session() as db:
+        try:
+            # The insert and the derived-table upserts share one code path with the sync API
+            count = await db.run_sync(_insert_rows, rows, server_timestamps)
+            await db.commit()
+            return count
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error inserting {len(rows)} interactions: {e}")
+            raise
+
+def to_local_naive(value):
+    # Timestamps are stored as naive local time: aware inputs are converted, naive ones kept
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+class StrictClock:
+    # datetime.now() that never repeats, so replayed lists keep their order by timestamp
+    def __init__(self):
+        self.previous = None
+
+    def now(self):
+        current = datetime.now()
+        if self.previous is not None and current <= self.previous:
+            current = self.previous + timedelta(microseconds=1)
+        self.previous = current
+        return current
+
+def events_to_rows(events, default_username=None, clock=None):
+    clock = clock or StrictClock()
+    rows = []
+    for item in events:
+        username = item.username or default_username
+        if not username:
+            raise ValueError(f"Missing username for action '{item.action}'")
+        timestamp = to_local_naive(item.timestamp)
+        if timestamp is None:
+            timestamp = clock.now()
+        rows.append((username, item.action, timestamp))
+    return rows
+
+def user_interaction_rows(username: str, actions):
+    clock = StrictClock()
+    return [(username, action, clock.now()) for action in actions]
+
+INTERACTIONS_PAGE_SIZE = int(os.getenv("INTERACTIONS_PAGE_SIZE", "1000"))
+INTERACTIONS_MAX_PAGE_SIZE = int(os.getenv("INTERACTIONS_MAX_PAGE_SIZE", "10000"))
+INTERACTIONS_STREAM_CHUNK_SIZE = int(os.getenv("INTERACTIONS_STREAM_CHUNK_SIZE", "5000"))
+
+def _interactions_select(username=None, after_id=None, since=None, until=None):
+    # The dictionary is tiny, joining it decodes the names in the same query
+    query = select(
+        Interaction.id, Interaction.username, Action.name.label("action"), Interaction.timestamp
+    ).outerjoin(Action, Action.id == Interaction.action_id)
+    if username is not None:
+        query = query.where(Interaction.username == username)
+    if after_id is not None:
+        query = query.where(Interaction.id > after_id)
+    if since is not None:
+        query = query.where(Interaction.timestamp >= since)
+    if until is not None:
+        query = query.where(Interaction.timestamp < until)
+    return query.order_by(Interaction.id)
+
+def get_interactions_page(username: str = None, after_id: int = None, limit: int = INTERACTIONS_PAGE_SIZE,
+                          since: datetime = None, until: datetime = None):
+    # Keyset pagination on id: pass the last id of a page as after_id to get the next one
+    db = get_session()
+    try:
+        rows = db.execute(_interactions_select(username, after_id, since, until).limit(limit))
+        return [row._asdict() for row in rows]
+    except Exception as e:
+        logging.error(f"Error retrieving interactions page: {e}")
         raise
     finally:
         db.close()
 
+def iter_interactions(username: str = None, since: datetime = None, until: datetime = None,
+                      chunk_size: int = INTERACTIONS_STREAM_CHUNK_SIZE):
+    # Yields lists of at most chunk_size rows from a server-side cursor
+    db = get_session()
+    try:
+        result = db.execute(
+            _interactions_select(username, None, since, until).execution_options(
+                stream_results=True, yield_per=chunk_size
+            )
+        )
+        for partition in result.partitions():
+            yield [row._asdict() for row in partition]
+    finally:
+        db.close()
+
+async def get_interactions_page_async(username: str = None, after_id: int = None, limit: int = INTERACTIONS_PAGE_SIZE,
+                                     since: datetime = None, until: datetime = None):
+    async with get_async_session() as db:
+        try:
+            rows = await db.execute(_interactions_select(username, after_id, since, until).limit(limit))
+            return [row._asdict() for row in rows]
+        except Exception as e:
+            logging.error(f"Error retrieving interactions page: {e}")
+            raise
+
+async def iter_interactions_async(username: str = None, since: datetime = None, until: datetime = None,
+                                  chunk_size: int = INTERACTIONS_STREAM_CHUNK_SIZE):
+    async with async_engine.connect() as connection:
+        result = await connection.stream(
+            _interactions_select(username, None, since, until).execution_options(yield_per=chunk_size)
+        )
+        async for partition in result.partitions():
+            yield [row._asdict() for row in partition]
+
 def get_interactions_by_user(username: str):
     db = get_session()
     try:
@@ -127,7 +838,7 @@ def create_user(username: str, password: str, isAdmin: bool = False):
         if existing_user:
             raise IntegrityError("Username already exists", None, None)
 
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
         db_user = User(
             username=username,
             password=hashed_password,
@@ -162,6 +873,50 @@ def login(username: str, password: str):
     finally:
         db.close()
 
+async def create_user_async(username: str, password: str, isAdmin: bool = False):
+    # No connection is held while bcrypt runs: look up, release, hash in the dedicated pool,
+    # then insert (the primary key still catches a concurrent signup)
+    if await get_user_async(username) is not None:
+        logging.error(f"Integrity error creating user {username}: username already exists")
+        raise IntegrityError("Username already exists", None, None)
+    hashed_password = await hash_password(password)
+    async with get_async_session() as db:
+        try:
+            db_user = User(
+                username=username,
+                password=hashed_password,
+                isAdmin=isAdmin
+            )
+            db.add(db_user)
+            await db.commit()
+            return db_user
+        except IntegrityError as ie:
+            await db.rollback()
+            logging.error(f"Integrity error creating user {username}: {ie}")
+            raise
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error creating user {username}: {e}")
+            raise
+
+async def login_async(username: str, password: str):
+    # The connection goes back to the pool before the password is checked
+    user = await get_user_async(username)
+    if user and await check_password(password, user.password):
+        return user
+    return None
+
+async def get_user_async(username: str):
+    async with get_async_session() as db:
+        try:
+            user = await db.get(User, username)
+            if user:
+                db.expunge(user)
+            return user
+        except Exception as e:
+            logging.error(f"Error retrieving user {username}: {e}")
+            raise
+
 def get_user(username: str):
     db = get_session()
     try:
@@ -3,16 +3,113 @@ import jwt
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from collections import OrderedDict
+import hashlib
 import logging
+import os
+import secrets
+import time
+import redis.asyncio as redis
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 SECRET_KEY = None  # Will be set dynamically
 ALGORITHM = "HS256"
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+DENYLIST_PREFIX = "token_denylist:"
+SECRET_KEY_REDIS_KEY = "auth:secret_key"
+# Tokens refused while the denylist cannot be read: "admin" (admin tokens only), "all",
+# or "none" to accept every token that is otherwise valid
+AUTH_FAIL_CLOSED = os.getenv("AUTH_FAIL_CLOSED", "admin").lower()
+
+redis_client = None  # Set at startup, holds the shared revocation denylist
+# sha256(token) -> verified claims, in LRU order; entries die at the token's exp
+token_cache = OrderedDict()
+token_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "revoked": 0, "denylist_errors": 0}
+
+
+class DenylistUnavailable(Exception):
+    pass
+
+
 def set_secret_key(secret_key):
     global SECRET_KEY
     SECRET_KEY = secret_key
+    token_cache.clear()
+
+def set_redis_client(client):
+    global redis_client
+    redis_client = client
+
+async def load_secret_key():
+    # Every worker must sign with the same key: SECRET_KEY from the environment, else one
+    # generated by the first worker to start and shared through Redis
+    secret_key = os.getenv("SECRET_KEY")
+    if not secret_key:
+        await redis_client.set(SECRET_KEY_REDIS_KEY, secrets.token_urlsafe(32), nx=True)
+        secret_key = await redis_client.get(SECRET_KEY_REDIS_KEY)
+    set_secret_key(secret_key)
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def decode_token(token: str) -> dict:
+    # jwt.decode with a bounded cache of already verified claims; raises jwt.PyJWTError
+    if SECRET_KEY is None:
+        raise ValueError("SECRET_KEY not set")
+    if not token:
+        raise jwt.InvalidTokenError("Missing token")
+    key = token_hash(token)
+    payload = token_cache.get(key)
+    if payload is not None:
+        if payload["exp"] > time.time():
+            token_cache.move_to_end(key)
+            token_cache_stats["hits"] += 1
+            return payload
+        del token_cache[key]
+        token_cache_stats["evictions"] += 1
+    token_cache_stats["misses"] += 1
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp"]})
+    token_cache[key] = payload
+    if len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+        token_cache_stats["evictions"] += 1
+    return payload
+
+async def is_token_revoked(token: str, role: str = None) -> bool:
+    # Raises DenylistUnavailable when the denylist cannot be read and AUTH_FAIL_CLOSED
+    # covers the token's role
+    if redis_client is None:
+        return False
+    try:
+        revoked = await redis_client.exists(DENYLIST_PREFIX + token_hash(token))
+    except redis.RedisError as e:
+        token_cache_stats["denylist_errors"] += 1
+        logging.error(f"Redis error while checking token denylist: {e}")
+        if AUTH_FAIL_CLOSED == "all" or (AUTH_FAIL_CLOSED == "admin" and role == "admin"):
+            raise DenylistUnavailable("Token denylist unavailable")
+        return False
+    if revoked:
+        token_cache_stats["revoked"] += 1
+    return bool(revoked)
+
+async def revoke_token(token: str):
+    # The denylist entry only needs to live until the token would expire anyway
+    payload = decode_token(token)
+    ttl = int(payload["exp"] - time.time()) + 1
+    token_cache.pop(token_hash(token), None)
+    if ttl > 0:
+        await redis_client.set(DENYLIST_PREFIX + token_hash(token), 1, ex=ttl)
+
+def get_token_cache_stats():
+    lookups = token_cache_stats["hits"] + token_cache_stats["misses"]
+    return {
+        "size": len(token_cache),
+        "max_size": TOKEN_CACHE_SIZE,
+        **token_cache_stats,
+        "hit_ratio": token_cache_stats["hits"] / lookups if lookups else 0.0,
+    }
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     if SECRET_KEY is None:
@@ -22,19 +119,25 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     if SECRET_KEY is None:
         raise ValueError("SECRET_KEY not set")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         role: str = payload.get("role")
-        if username is None or role is None:
+        if username is None or role is None or await is_token_revoked(token, role):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token",
             )
         return {"username": username, "role": role}
+    except DenylistUnavailable:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication temporarily unavailable",
+            headers={"Retry-After": "1"},
+        )
     except jwt.PyJWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -42,7 +145,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         )
 
 def role_required(required_role: str):
-    def role_dependency(current_user: dict = Depends(get_current_user)):
+    async def role_dependency(current_user: dict = Depends(get_current_user)):
         if current_user["role"] != required_role:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -51,34 +154,34 @@ def role_required(required_role: str):
         return current_user
     return role_dependency
 
-def get_current_username_optional(token: str = Depends(oauth2_scheme)):
+async def get_current_username_optional(token: str = Depends(oauth2_scheme)):
     if SECRET_KEY is None:
         raise ValueError("SECRET_KEY not set")
     if not token:
         return "anonymous"
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or await is_token_revoked(token, payload.get("role")):
             return "anonymous"
         return username
-    except jwt.PyJWTError:
+    except (jwt.PyJWTError, DenylistUnavailable):
         return "anonymous"
 
-def isTokenValidAndUser(token: str):
+async def isTokenValidAndUser(token: str):
     if SECRET_KEY is None:
         raise ValueError("SECRET_KEY not set")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         # check if the token is expired
         expire = payload.get("exp")
         if expire < datetime.now().timestamp():
             return {"valid": False, "username": None}
         username: str = payload.get("sub")
         role: str = payload.get("role")
-        if username is None or role is None:
+        if username is None or role is None or await is_token_revoked(token, role):
             return {"valid": False, "username": None}
         return {"valid": True, "username": username}
-    except jwt.PyJWTError:
+    except (jwt.PyJWTError, DenylistUnavailable):
         return {"valid": False, "username": None}
     
\ No newline at end of file
@@ -0,0 +1,76 @@
+# live_stats.py
+import logging
+import os
+
+from locks import redis_lock
+from utils import compute_usage_stats, compute_interactions_stats
+
+TOTAL_KEY = "stats:total_interactions"
+PER_USER_KEY = "stats:interactions_per_user"
+USERS_HLL_KEY = "stats:users_hll"
+
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
+RECONCILE_CHUNK_SIZE = 1000
+RECONCILE_LOCK_KEY = "stats:reconcile_lock"
+# Longest a reconciliation may hold the lock before another worker can take it
+RECONCILE_LOCK_TIMEOUT = 300
+
+
+async def record_interactions(redis_client, rows):
+    # rows: (username, action, timestamp) tuples that were just committed
+    per_user = {}
+    for username, _, _ in rows:
+        per_user[username] = per_user.get(username, 0) + 1
+    if not per_user:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.incrby(TOTAL_KEY, sum(per_user.values()))
+        for username, count in per_user.items():
+            pipe.hincrby(PER_USER_KEY, username, count)
+        pipe.pfadd(USERS_HLL_KEY, *per_user)
+        await pipe.execute()
+
+
+async def get_usage_stats(redis_client):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(TOTAL_KEY)
+        pipe.pfcount(USERS_HLL_KEY)
+        total, users = await pipe.execute()
+    if total is None:
+        await reconcile(redis_client, if_missing=True)
+        return await get_usage_stats(redis_client)
+    return {"total_interactions": int(total), "total_users": users}
+
+
+async def get_interactions_stats(redis_client):
+    if not await redis_client.exists(TOTAL_KEY):
+        await reconcile(redis_client, if_missing=True)
+    per_user = await redis_client.hgetall(PER_USER_KEY)
+    return [{"username": username, "interaction_count": int(count)} for username, count in per_user.items()]
+
+
+async def reconcile(redis_client, if_missing=False, wait=True):
+    # Overwrites the live counters with exact values from the database. Events recorded
+    # while the queries run can be off by a few until the next pass.
+    # if_missing: only when the counters do not exist (yet), e.g. checked again once a
+    # concurrent reconciliation released the lock. wait=False skips the run if one is going.
+    # One reconciliation at a time across workers
+    async with redis_lock(redis_client, RECONCILE_LOCK_KEY, RECONCILE_LOCK_TIMEOUT, wait) as acquired:
+        if not acquired or (if_missing and await redis_client.exists(TOTAL_KEY)):
+            return
+        await _reconcile(redis_client)
+
+
+async def _reconcile(redis_client):
+    usage = await compute_usage_stats()
+    per_user = await compute_interactions_stats()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(PER_USER_KEY, USERS_HLL_KEY)
+        pipe.set(TOTAL_KEY, usage["total_interactions"])
+        for start in range(0, len(per_user), RECONCILE_CHUNK_SIZE):
+            chunk = per_user[start:start + RECONCILE_CHUNK_SIZE]
+            pipe.hset(PER_USER_KEY, mapping={row["username"]: row["interaction_count"] for row in chunk})
+            pipe.pfadd(USERS_HLL_KEY, *(row["username"] for row in chunk))
+        await pipe.execute()
+    logging.info(f"Live stats reconciled: {usage['total_interactions']} interactions, {len(per_user)} users.")
+
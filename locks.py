@@ -0,0 +1,78 @@
+# locks.py
+import asyncio
+import secrets
+import time
+from contextlib import asynccontextmanager
+
+import redis.asyncio as redis
+
+
+# Redis locks shared by the workers: SET NX PX with a random token, so only the holder
+# renews or releases it, and a holder that dies frees it when the lease runs out.
+# Work with both decoding and raw clients.
+
+def new_token():
+    return secrets.token_hex(8)
+
+
+def _holds(value, token):
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value == token
+
+
+async def acquire_lock(redis_client, key, timeout, token=None):
+    # Returns the token if the lock was free, else None
+    token = token or new_token()
+    if await redis_client.set(key, token, nx=True, px=int(timeout * 1000)):
+        return token
+    return None
+
+
+async def renew_lock(redis_client, key, token, timeout):
+    # Extends the lease if token still holds the lock
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(key)
+            if not _holds(await pipe.get(key), token):
+                return False
+            pipe.multi()
+            pipe.pexpire(key, int(timeout * 1000))
+            await pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
+
+
+async def release_lock(redis_client, key, token):
+    # Only deletes the lock if it is still ours (it may have expired and been taken over)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(key)
+            if _holds(await pipe.get(key), token):
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+        except redis.WatchError:
+            pass
+
+
+@asynccontextmanager
+async def redis_lock(redis_client, key, timeout, wait=True, wait_timeout=None, poll_interval=0.1):
+    # Yields True once the lock is held, released on exit. Without wait, yields False at once
+    # when another holder has it; with wait_timeout, raises TimeoutError after that long.
+    deadline = None if wait_timeout is None else time.monotonic() + wait_timeout
+    while True:
+        token = await acquire_lock(redis_client, key, timeout)
+        if token is not None:
+            break
+        if not wait:
+            yield False
+            return
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for the lock {key}")
+        await asyncio.sleep(poll_interval)
+    try:
+        yield True
+    finally:
+        await release_lock(redis_client, key, token)
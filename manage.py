@@ -0,0 +1,156 @@
+# manage.py
+import argparse
+import logging
+import sys
+
+from datetime import datetime, timedelta
+
+from interactions import rebuild_transitions, compact_rollups
+from migrations import migrate, check_query_plans, partition_interactions_by_month, create_month_partitions
+from transfer import TRANSFER_FORMATS, TRANSFER_CHUNK_SIZE, export_interactions, import_file
+from retention import RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE, archive_interactions
+
+
+def cmd_rebuild_transitions(args):
+    rebuild_transitions(args.username)
+    target = f"user {args.username}" if args.username else "all users"
+    logging.info(f"Transition counts rebuilt for {target}.")
+
+
+def cmd_compact_rollups(args):
+    until = args.until or datetime.now()
+    since = args.since or until - timedelta(hours=args.hours)
+    compact_rollups(since, until)
+    logging.info(f"Rollups recomputed from {since} to {until}.")
+
+
+def cmd_migrate(args):
+    applied = migrate()
+    logging.info(f"Applied {len(applied)} migration(s)." if applied else "Schema is up to date.")
+
+
+def cmd_check_plans(args):
+    results = check_query_plans()
+    for result in results:
+        status = "OK  " if result["uses_index"] else "FAIL"
+        print(f"{status} {result['query']} (expects {result['index']})")
+        if args.verbose or not result["uses_index"]:
+            print("     " + result["plan"].replace("\n", "\n     "))
+    if not all(result["uses_index"] for result in results):
+        raise SystemExit(1)
+
+
+def cmd_partition_interactions(args):
+    partition_interactions_by_month(months_ahead=args.months_ahead)
+
+
+def cmd_create_partitions(args):
+    create_month_partitions(months_ahead=args.months_ahead)
+
+
+def _transfer_format(args, path):
+    return args.format or ("parquet" if path.endswith(".parquet") else "csv")
+
+
+def cmd_export(args):
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for data in export_interactions(
+            _transfer_format(args, args.output), args.username, args.since, args.until, args.chunk_size
+        ):
+            output.write(data)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+def cmd_import(args):
+    count = import_file(args.input, _transfer_format(args, args.input), args.chunk_size, rebuild=not args.no_rebuild)
+    logging.info(f"Imported {count} interactions from {args.input}.")
+    if args.no_rebuild:
+        logging.info("Derived tables not rebuilt: run rebuild-transitions and compact-rollups.")
+
+
+def cmd_archive(args):
+    if args.before is None and args.days <= 0:
+        raise SystemExit("Give --days or --before, or set RETENTION_DAYS")
+    older_than = args.before or datetime.now() - timedelta(days=args.days)
+    count = archive_interactions(older_than, args.batch_size, args.pause, args.max_batches)
+    logging.info(f"Archived {count} interactions older than {older_than}.")
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintenance commands for the interactions API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser(
+        "rebuild-transitions",
+        help="Regenerate the Markov transition counts from the interactions table",
+    )
+    rebuild.add_argument("--username", help="Only rebuild this user")
+    rebuild.set_defaults(func=cmd_rebuild_transitions)
+
+    compact = subparsers.add_parser(
+        "compact-rollups",
+        help="Recompute the time-bucketed rollups of a time range from the interactions table",
+    )
+    compact.add_argument("--from", dest="since", type=datetime.fromisoformat, help="Start (ISO 8601)")
+    compact.add_argument("--to", dest="until", type=datetime.fromisoformat, help="End (ISO 8601), defaults to now")
+    compact.add_argument("--hours", type=float, default=2, help="Range length when --from is not given")
+    compact.set_defaults(func=cmd_compact_rollups)
+
+    subparsers.add_parser("migrate", help="Apply pending schema migrations").set_defaults(func=cmd_migrate)
+
+    check_plans = subparsers.add_parser("check-plans", help="Check that the hot queries are served by indexes")
+    check_plans.add_argument("--verbose", action="store_true", help="Print every query plan")
+    check_plans.set_defaults(func=cmd_check_plans)
+
+    partition = subparsers.add_parser(
+        "partition-interactions",
+        help="Convert interactions to a monthly range-partitioned table (PostgreSQL, takes an exclusive lock)",
+    )
+    partition.add_argument("--months-ahead", type=int, default=3)
+    partition.set_defaults(func=cmd_partition_interactions)
+
+    partitions = subparsers.add_parser("create-partitions", help="Create the upcoming monthly partitions")
+    partitions.add_argument("--months-ahead", type=int, default=3)
+    partitions.set_defaults(func=cmd_create_partitions)
+
+    export = subparsers.add_parser("export-interactions", help="Write the interactions to a CSV or Parquet file")
+    export.add_argument("output", help="Output file, or - for stdout")
+    export.add_argument("--format", choices=TRANSFER_FORMATS, help="Defaults to the file extension, else csv")
+    export.add_argument("--username", help="Only export this user")
+    export.add_argument("--from", dest="since", type=datetime.fromisoformat, help="Start (ISO 8601)")
+    export.add_argument("--to", dest="until", type=datetime.fromisoformat, help="End (ISO 8601, exclusive)")
+    export.add_argument("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE, help="Rows per read and row group")
+    export.set_defaults(func=cmd_export)
+
+    load = subparsers.add_parser(
+        "import-interactions",
+        help="Load interactions from a CSV or Parquet file (columns username, action, timestamp)",
+    )
+    load.add_argument("input")
+    load.add_argument("--format", choices=TRANSFER_FORMATS, help="Defaults to the file extension, else csv")
+    load.add_argument("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE, help="Rows per transaction")
+    load.add_argument("--no-rebuild", action="store_true",
+                      help="Skip recomputing the transitions and rollups after the import")
+    load.set_defaults(func=cmd_import)
+
+    archive = subparsers.add_parser(
+        "archive-interactions",
+        help="Move old interactions out of the interactions table into the archived aggregates",
+    )
+    archive.add_argument("--days", type=float, default=RETENTION_DAYS, help="Age of the rows to archive")
+    archive.add_argument("--before", type=datetime.fromisoformat, help="Archive rows older than this (ISO 8601)")
+    archive.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE, help="Rows per transaction")
+    archive.add_argument("--pause", type=float, default=RETENTION_BATCH_PAUSE, help="Seconds between transactions")
+    archive.add_argument("--max-batches", type=int, help="Stop after this many transactions")
+    archive.set_defaults(func=cmd_archive)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
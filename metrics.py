@@ -0,0 +1,194 @@
+# metrics.py
+import asyncio
+import logging
+import os
+import time
+from functools import wraps
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "SQL statement execution time",
+    ["engine", "operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    ["engine"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+COMPUTE_DURATION = Histogram(
+    "compute_duration_seconds",
+    "Duration of the statistics and model computations",
+    ["function"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: times the whole response, streamed bodies included
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, not the raw path, keeps the label set bounded
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"], route.path if route is not None else "unmatched", str(status)
+            ).observe(time.perf_counter() - start)
+
+
+def timed(function_name):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with COMPUTE_DURATION.labels(function_name).time():
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with COMPUTE_DURATION.labels(function_name).time():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_engine(engine, name):
+    # engine: a sync Engine (use async_engine.sync_engine for the async one)
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_QUERY_DURATION.labels(name, operation).observe(elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+    # The pool has no "before checkout" event, so the wait is timed around the engine's
+    # public connect(), through which sessions (the async ones included) get their
+    # connections; the pre-ping is part of it
+    connect = engine.connect
+
+    @wraps(connect)
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.labels(name).observe(time.perf_counter() - start)
+
+    engine.connect = timed_connect
+    _pools[name] = engine.pool
+
+
+_pools = {}
+_stats_sources = {}
+_threadpool_limiter = None
+
+
+def watch_threadpool():
+    # Must run inside the event loop: starlette's run_in_threadpool uses anyio's default limiter
+    global _threadpool_limiter
+    import anyio.to_thread
+    _threadpool_limiter = anyio.to_thread.current_default_thread_limiter()
+
+
+def register_stats(subsystem, stats):
+    # stats: callable returning a dict; its numeric values are exported as gauges
+    _stats_sources[subsystem] = stats
+
+
+class StatsCollector:
+    def collect(self):
+        pool_gauges = {
+            key: GaugeMetricFamily(f"db_pool_{key}", description, labels=["engine"])
+            for key, description in (
+                ("size", "Configured pool size"),
+                ("checked_out", "Connections currently in use"),
+                ("checked_in", "Idle connections in the pool"),
+                ("overflow", "Connections opened beyond the pool size"),
+            )
+        }
+        for name, pool in _pools.items():
+            for key, method in (("size", "size"), ("checked_out", "checkedout"),
+                                ("checked_in", "checkedin"), ("overflow", "overflow")):
+                if hasattr(pool, method):
+                    pool_gauges[key].add_metric([name], getattr(pool, method)())
+        yield from pool_gauges.values()
+
+        if _threadpool_limiter is not None:
+            statistics = _threadpool_limiter.statistics()
+            yield GaugeMetricFamily("threadpool_size", "Threads available to run_in_threadpool",
+                                    value=_threadpool_limiter.total_tokens)
+            yield GaugeMetricFamily("threadpool_busy", "Threads running a run_in_threadpool call",
+                                    value=statistics.borrowed_tokens)
+            yield GaugeMetricFamily("threadpool_queue_depth", "Calls waiting for a free thread",
+                                    value=statistics.tasks_waiting)
+
+        for subsystem, stats in _stats_sources.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logging.error(f"Could not collect {subsystem} stats: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    # {label: {field: number}}, e.g. the cache counters per key prefix
+                    families = {}
+                    for label, fields in value.items():
+                        for field, number in fields.items():
+                            if field not in families:
+                                families[field] = GaugeMetricFamily(
+                                    f"{subsystem}_{field}", f"{subsystem} {field.replace('_', ' ')}", labels=["key"]
+                                )
+                            families[field].add_metric([label], number)
+                    yield from families.values()
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield GaugeMetricFamily(f"{subsystem}_{key}", f"{subsystem} {key.replace('_', ' ')}", value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def render():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Several workers: the histograms are merged from every worker's files, the gauges
+        # describe the worker answering the scrape
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(stats_collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,349 @@
+# migrations.py
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, inspect, select, text
+
+from interactions import Base, engine, ROLLUP_GRANULARITIES, PREDICTION_MARKOV_ORDER
+
+# Bookkeeping lives in its own metadata so create_all on the models never touches it
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Arbitrary constant used as the Postgres advisory lock key for migrations
+MIGRATION_LOCK_ID = 7_264_001
+
+
+def _create_index(connection, name, table, *columns):
+    Index(name, *(Base.metadata.tables[table].c[column] for column in columns)).create(
+        connection, checkfirst=True
+    )
+
+
+def _columns(connection, table):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+# Migrations never call the application's helpers, which keep changing with the schema:
+# each one works on the tables as they were at its version, defined here
+_v5_tables = MetaData()
+Table(
+    "action_transitions", _v5_tables,
+    Column("username", String, primary_key=True),
+    Column("from_action_id", Integer, primary_key=True),
+    Column("to_action_id", Integer, primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+)
+Table(
+    "user_last_actions", _v5_tables,
+    Column("username", String, primary_key=True),
+    Column("action_id", Integer),
+    Column("timestamp", DateTime),
+)
+Table(
+    "action_rollups", _v5_tables,
+    Column("granularity", String, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("action_id", Integer, primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+)
+Table(
+    "user_rollups", _v5_tables,
+    Column("granularity", String, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("username", String, primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+)
+
+_v6_tables = MetaData()
+Table(
+    "action_trigrams", _v6_tables,
+    Column("username", String, primary_key=True),
+    Column("before_action_id", Integer, primary_key=True),
+    Column("from_action_id", Integer, primary_key=True),
+    Column("to_action_id", Integer, primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+)
+
+# Each interaction with the one or two actions before it, and its rank from the user's last
+_ORDERED_INTERACTIONS = (
+    "SELECT username, action_id, timestamp,"
+    " lag(action_id) OVER (PARTITION BY username ORDER BY timestamp, id) AS previous_action,"
+    " lag(action_id, 2) OVER (PARTITION BY username ORDER BY timestamp, id) AS before_action,"
+    " row_number() OVER (PARTITION BY username ORDER BY timestamp DESC, id DESC) AS position_from_end"
+    " FROM interactions"
+)
+
+
+def _bucket_sql(connection, granularity):
+    if connection.dialect.name == "postgresql":
+        return f"date_trunc('{granularity}', timestamp)"
+    # Same text layout SQLAlchemy uses to store DateTime values on SQLite
+    formats = {
+        "minute": "%Y-%m-%d %H:%M:00.000000",
+        "hour": "%Y-%m-%d %H:00:00.000000",
+        "day": "%Y-%m-%d 00:00:00.000000",
+    }
+    return f"strftime('{formats[granularity]}', timestamp)"
+
+
+# Every migration must be idempotent: a fresh database gets the whole current schema from
+# the baseline, so later steps only do work on databases created by older versions.
+def m001_baseline(connection):
+    Base.metadata.create_all(bind=connection)
+
+
+def m002_username_timestamp_index(connection):
+    _create_index(connection, "ix_interactions_username_timestamp", "interactions", "username", "timestamp")
+
+
+def m003_action_index(connection):
+    # Only databases still storing the action name have this column; m005 replaces it
+    if "action" in _columns(connection, "interactions"):
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_interactions_action ON interactions (action)"))
+
+
+def m004_rollup_tables(connection):
+    Base.metadata.create_all(
+        bind=connection,
+        tables=[Base.metadata.tables["action_rollups"], Base.metadata.tables["user_rollups"]],
+    )
+
+
+def m005_action_dictionary(connection):
+    Base.metadata.create_all(bind=connection, tables=[Base.metadata.tables["actions"]])
+    if "action" not in _columns(connection, "interactions"):
+        return
+    connection.execute(text(
+        "INSERT INTO actions (name) SELECT DISTINCT action FROM interactions"
+        " WHERE action IS NOT NULL AND action NOT IN (SELECT name FROM actions) ORDER BY action"
+    ))
+    connection.execute(text("ALTER TABLE interactions ADD COLUMN action_id INTEGER REFERENCES actions (id)"))
+    connection.execute(text(
+        "UPDATE interactions SET action_id = (SELECT id FROM actions WHERE actions.name = interactions.action)"
+    ))
+    connection.execute(text("DROP INDEX IF EXISTS ix_interactions_action"))
+    connection.execute(text("ALTER TABLE interactions DROP COLUMN action"))
+    _create_index(connection, "ix_interactions_action_id", "interactions", "action_id")
+
+    # The derived tables were keyed by action name too: recreate them and recount. The
+    # user rollups are recounted with them, m004 created them empty.
+    derived = [
+        _v5_tables.tables[name]
+        for name in ("action_transitions", "user_last_actions", "action_rollups", "user_rollups")
+    ]
+    _v5_tables.drop_all(bind=connection, tables=derived)
+    _v5_tables.create_all(bind=connection, tables=derived)
+    connection.execute(text(
+        "INSERT INTO action_transitions (username, from_action_id, to_action_id, count)"
+        " SELECT username, previous_action, action_id, count(*) FROM ("
+        + _ORDERED_INTERACTIONS + ") AS ordered"
+        " WHERE previous_action IS NOT NULL GROUP BY username, previous_action, action_id"
+    ))
+    connection.execute(text(
+        "INSERT INTO user_last_actions (username, action_id, timestamp)"
+        " SELECT username, action_id, timestamp FROM (" + _ORDERED_INTERACTIONS + ") AS ordered"
+        " WHERE position_from_end = 1"
+    ))
+    for granularity in ROLLUP_GRANULARITIES:
+        bucket = _bucket_sql(connection, granularity)
+        connection.execute(text(
+            "INSERT INTO action_rollups (granularity, bucket, action_id, count)"
+            f" SELECT :granularity, {bucket}, action_id, count(*) FROM interactions"
+            f" WHERE timestamp IS NOT NULL GROUP BY {bucket}, action_id"
+        ), {"granularity": granularity})
+        connection.execute(text(
+            "INSERT INTO user_rollups (granularity, bucket, username, count)"
+            f" SELECT :granularity, {bucket}, username, count(*) FROM interactions"
+            f" WHERE timestamp IS NOT NULL GROUP BY {bucket}, username"
+        ), {"granularity": granularity})
+
+
+def m006_trigram_counts(connection):
+    _v6_tables.create_all(bind=connection, tables=[_v6_tables.tables["action_trigrams"]])
+    if "previous_action_id" in _columns(connection, "user_last_actions"):
+        return
+    connection.execute(text("ALTER TABLE user_last_actions ADD COLUMN previous_action_id INTEGER"))
+    # Fills previous_action_id (and the trigrams, if enabled) from the history
+    connection.execute(text(
+        "UPDATE user_last_actions SET previous_action_id = ("
+        " SELECT previous_action FROM (" + _ORDERED_INTERACTIONS + ") AS ordered"
+        " WHERE ordered.username = user_last_actions.username AND position_from_end = 1)"
+    ))
+    if PREDICTION_MARKOV_ORDER >= 2:
+        connection.execute(text(
+            "INSERT INTO action_trigrams (username, before_action_id, from_action_id, to_action_id, count)"
+            " SELECT username, before_action, previous_action, action_id, count(*) FROM ("
+            + _ORDERED_INTERACTIONS + ") AS ordered"
+            " WHERE before_action IS NOT NULL GROUP BY username, before_action, previous_action, action_id"
+        ))
+
+
+def m007_archive_tables(connection):
+    Base.metadata.create_all(
+        bind=connection,
+        tables=[
+            Base.metadata.tables[name]
+            for name in ("archived_interaction_counts", "archived_transitions", "archived_trigrams", "archived_last_actions")
+        ],
+    )
+
+
+MIGRATIONS = [
+    (1, "baseline", m001_baseline),
+    (2, "interactions (username, timestamp) index", m002_username_timestamp_index),
+    (3, "interactions action index", m003_action_index),
+    (4, "time-bucketed rollup tables", m004_rollup_tables),
+    (5, "actions dictionary table", m005_action_dictionary),
+    (6, "trigram transition counts", m006_trigram_counts),
+    (7, "archived interaction aggregates", m007_archive_tables),
+]
+
+
+def _lock(connection):
+    # Only one process migrates at a time; the lock is released with the transaction
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+
+def applied_versions(connection):
+    migration_metadata.create_all(bind=connection)
+    return set(connection.scalars(select(schema_migrations.c.version)))
+
+
+def migrate(bind=engine):
+    applied = []
+    with bind.begin() as connection:
+        _lock(connection)
+        done = applied_versions(connection)
+        for version, name, upgrade in MIGRATIONS:
+            if version in done:
+                continue
+            with connection.begin_nested():
+                upgrade(connection)
+                connection.execute(
+                    schema_migrations.insert().values(version=version, name=name, applied_at=datetime.now())
+                )
+            logging.info(f"Applied migration {version:03d}: {name}")
+            applied.append(version)
+    return applied
+
+
+def partition_interactions_by_month(bind=engine, months_ahead=3):
+    # Opt-in, PostgreSQL only: turns interactions into a table range-partitioned by month.
+    # Rewrites the whole table under an exclusive lock, so run it in a maintenance window.
+    if bind.dialect.name != "postgresql":
+        raise NotImplementedError("Partitioning is only supported on PostgreSQL")
+    with bind.begin() as connection:
+        _lock(connection)
+        if connection.scalar(text(
+            "SELECT c.relkind = 'p' FROM pg_class c WHERE c.oid = 'interactions'::regclass"
+        )):
+            logging.info("interactions is already partitioned.")
+            return
+        connection.execute(text("LOCK TABLE interactions IN ACCESS EXCLUSIVE MODE"))
+        connection.execute(text("ALTER SEQUENCE interactions_id_seq OWNED BY NONE"))
+        connection.execute(text("ALTER TABLE interactions RENAME TO interactions_unpartitioned"))
+        connection.execute(text(
+            "CREATE TABLE interactions ("
+            " id integer NOT NULL DEFAULT nextval('interactions_id_seq'),"
+            " username varchar, action_id integer REFERENCES actions (id), timestamp timestamp NOT NULL,"
+            " PRIMARY KEY (id, timestamp)"
+            ") PARTITION BY RANGE (timestamp)"
+        ))
+        connection.execute(text("ALTER SEQUENCE interactions_id_seq OWNED BY interactions.id"))
+        connection.execute(text("CREATE TABLE interactions_default PARTITION OF interactions DEFAULT"))
+        oldest = connection.scalar(text("SELECT min(timestamp) FROM interactions_unpartitioned"))
+        _create_month_partitions(connection, oldest or datetime.now(), months_ahead)
+        connection.execute(text(
+            "INSERT INTO interactions (id, username, action_id, timestamp)"
+            " SELECT id, username, action_id, coalesce(timestamp, 'epoch'::timestamp) FROM interactions_unpartitioned"
+        ))
+        connection.execute(text("DROP TABLE interactions_unpartitioned"))
+        for name, columns in _interaction_indexes().items():
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON interactions ({columns})"))
+    logging.info("interactions is now partitioned by month.")
+
+
+def create_month_partitions(bind=engine, months_ahead=3):
+    # Run periodically (e.g. from cron) so upcoming months never fall into the default partition
+    with bind.begin() as connection:
+        _create_month_partitions(connection, datetime.now(), months_ahead)
+
+
+def _interaction_indexes():
+    return {
+        index.name: ", ".join(column.name for column in index.columns)
+        for index in Base.metadata.tables["interactions"].indexes
+    }
+
+
+def _create_month_partitions(connection, start, months_ahead):
+    month = datetime(start.year, start.month, 1)
+    now = datetime.now()
+    last = (now.year * 12 + now.month - 1) + months_ahead
+    while month.year * 12 + month.month - 1 <= last:
+        following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS interactions_{month:%Y_%m} PARTITION OF interactions"
+            f" FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        ))
+        month = following
+
+
+# Hot queries and the index each one is expected to be served by
+HOT_QUERIES = [
+    (
+        "interactions of one user in time order",
+        "SELECT id, action_id, timestamp FROM interactions WHERE username = :username ORDER BY timestamp",
+        "ix_interactions_username_timestamp",
+    ),
+    (
+        "interactions of one user in a time range",
+        "SELECT id, action_id FROM interactions WHERE username = :username AND timestamp >= :since",
+        "ix_interactions_username_timestamp",
+    ),
+    (
+        "interactions per user",
+        "SELECT username, count(*) FROM interactions GROUP BY username",
+        "ix_interactions_username_timestamp",
+    ),
+    (
+        "interactions of one action",
+        "SELECT count(*) FROM interactions WHERE action_id = :action_id",
+        "ix_interactions_action_id",
+    ),
+]
+
+
+def check_query_plans(bind=engine):
+    # Sequential scans are disabled on Postgres so the result does not depend on table size:
+    # a query that still plans a seq scan has no usable index.
+    params = {"username": "anonymous", "action_id": 1, "since": datetime(1970, 1, 1)}
+    results = []
+    with bind.connect() as connection:
+        with connection.begin():
+            if connection.dialect.name == "postgresql":
+                connection.execute(text("SET LOCAL enable_seqscan = off"))
+                explain = "EXPLAIN "
+            else:
+                explain = "EXPLAIN QUERY PLAN "
+            for description, query, index in HOT_QUERIES:
+                plan = "\n".join(
+                    " ".join(str(value) for value in row)
+                    for row in connection.execute(text(explain + query), params)
+                )
+                results.append({
+                    "query": description,
+                    "index": index,
+                    # Partitions carry their own copies of the index under generated names
+                    "uses_index": index in plan or (explain == "EXPLAIN " and "Seq Scan" not in plan),
+                    "plan": plan,
+                })
+    return results
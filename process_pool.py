@@ -0,0 +1,93 @@
+# process_pool.py
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Worker-side wrapper: reports when the job started so the caller can tell queue wait
+# from run time
+def _run(fn, args):
+    started = time.time()
+    return fn(*args), started
+
+
+class BoundedProcessPool:
+    # Runs CPU-bound jobs in separate processes with a bounded backlog: beyond size running
+    # and queue_size waiting jobs, run() raises busy_error at once instead of queueing.
+    # Started on first use, so only workers that need the pool pay for it.
+    def __init__(self, name, size, queue_size, busy_error, max_tasks_per_child=0, run_label="run", info=None):
+        self.name = name
+        self.size = size
+        self.queue_size = queue_size
+        self.busy_error = busy_error
+        # Jobs a process runs before it is replaced by a fresh one; 0 keeps it for the
+        # life of the pool
+        self.max_tasks_per_child = max_tasks_per_child
+        self.run_label = run_label
+        # Fixed values reported by stats(), e.g. the bcrypt cost
+        self.info = info or {}
+        self._executor = None
+        self.in_flight = 0
+        self.counters = {
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "wait_seconds_total": 0.0,
+            "max_wait_seconds": 0.0,
+            f"{run_label}_seconds_total": 0.0,
+        }
+
+    def start(self):
+        if self._executor is None:
+            # spawn keeps the workers free of the API's threads, sockets and event loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=self.max_tasks_per_child or None,
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        # fn must be a module-level function; it runs in a worker process
+        if self.in_flight >= self.size + self.queue_size:
+            self.counters["rejected"] += 1
+            raise self.busy_error(f"{self.name} queue is full")
+        self.start()
+        self.in_flight += 1
+        submitted = time.time()
+        try:
+            result, started = await asyncio.get_running_loop().run_in_executor(self._executor, _run, fn, args)
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        finished = time.time()
+        wait = max(started - submitted, 0.0)
+        self.counters["completed"] += 1
+        self.counters["wait_seconds_total"] += wait
+        self.counters["max_wait_seconds"] = max(self.counters["max_wait_seconds"], wait)
+        self.counters[f"{self.run_label}_seconds_total"] += finished - started
+        return result
+
+    def stats(self):
+        completed = self.counters["completed"]
+        return {
+            "pool_size": self.size,
+            "queue_size": self.queue_size,
+            "max_tasks_per_child": self.max_tasks_per_child,
+            **self.info,
+            "started": int(self._executor is not None),
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.size, 0),
+            **self.counters,
+            "avg_wait_seconds": self.counters["wait_seconds_total"] / completed if completed else 0.0,
+            f"avg_{self.run_label}_seconds": (
+                self.counters[f"{self.run_label}_seconds_total"] / completed if completed else 0.0
+            ),
+        }
@@ -0,0 +1,124 @@
+# retention.py
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, text
+
+from interactions import (
+    Interaction, ArchivedInteractionCount, ArchivedTransition, ArchivedTrigram, ArchivedLastAction,
+    get_session, truncate_timestamp, _dialect_insert, _upsert_counts
+)
+
+# Interactions older than this many days are archived; 0 keeps every raw row
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Rows archived per transaction, the pause between two transactions, and how many
+# transactions one scheduled run may use before leaving the rest to the next run
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "100"))
+
+# Arbitrary constant used as the Postgres advisory lock key for archiving
+RETENTION_LOCK_ID = 7_264_002
+
+
+def _lock(db):
+    # Batches must be archived one after the other, oldest first, for the per-user
+    # sequences to line up; the lock is released with the transaction
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": RETENTION_LOCK_ID})
+
+
+def _archive_batch(db, cutoff, batch_size):
+    # Folds the oldest interactions before cutoff into the archive tables and deletes them.
+    # Ingestion never writes to the archive tables nor to old rows, so it is not blocked.
+    rows = db.execute(
+        select(Interaction.id, Interaction.username, Interaction.action_id, Interaction.timestamp)
+        .where(Interaction.timestamp < cutoff)
+        .order_by(Interaction.timestamp, Interaction.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+
+    by_user = {}
+    daily_counts = {}
+    for _, username, action_id, timestamp in rows:
+        by_user.setdefault(username, []).append((timestamp, action_id))
+        key = (truncate_timestamp(timestamp, "day"), username, action_id)
+        daily_counts[key] = daily_counts.get(key, 0) + 1
+    usernames = sorted(by_user)
+
+    db.execute(
+        _dialect_insert(db, ArchivedLastAction).on_conflict_do_nothing(index_elements=["username"]),
+        [{"username": username, "interaction_count": 0} for username in usernames],
+    )
+    archived = {
+        last.username: last
+        for last in db.scalars(
+            select(ArchivedLastAction)
+            .where(ArchivedLastAction.username.in_(usernames))
+            .order_by(ArchivedLastAction.username)
+            .with_for_update()
+        )
+    }
+
+    # Same walk as on ingest, starting from where the archive of each user ends.
+    # Trigrams are always kept so the prediction order can still be raised later.
+    counts = {}
+    trigram_counts = {}
+    for username in usernames:
+        last = archived[username]
+        before, previous = last.previous_action_id, last.action_id
+        for _, action in by_user[username]:
+            if previous is not None:
+                key = (username, previous, action)
+                counts[key] = counts.get(key, 0) + 1
+                if before is not None:
+                    key = (username, before, previous, action)
+                    trigram_counts[key] = trigram_counts.get(key, 0) + 1
+            before, previous = previous, action
+        last.previous_action_id, last.action_id = before, previous
+        last.timestamp = by_user[username][-1][0]
+        last.interaction_count += len(by_user[username])
+
+    _upsert_counts(db, ArchivedInteractionCount, ["day", "username", "action_id"], daily_counts)
+    _upsert_counts(db, ArchivedTransition, ["username", "from_action_id", "to_action_id"], counts)
+    _upsert_counts(
+        db, ArchivedTrigram, ["username", "before_action_id", "from_action_id", "to_action_id"], trigram_counts
+    )
+    db.execute(delete(Interaction).where(Interaction.id.in_([row[0] for row in rows])))
+    return len(rows)
+
+
+def archive_interactions(older_than: datetime = None, batch_size: int = RETENTION_BATCH_SIZE,
+                         pause: float = RETENTION_BATCH_PAUSE, max_batches: int = None):
+    # Moves interactions older than older_than (default: RETENTION_DAYS ago) out of the hot
+    # table, one short transaction per batch. Returns the number of rows archived.
+    if older_than is None:
+        if RETENTION_DAYS <= 0:
+            return 0
+        older_than = datetime.now() - timedelta(days=RETENTION_DAYS)
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        db = get_session()
+        try:
+            _lock(db)
+            count = _archive_batch(db, older_than, batch_size)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logging.error(f"Error archiving interactions after {total} rows: {e}")
+            raise
+        finally:
+            db.close()
+        total += count
+        batches += 1
+        if count < batch_size:
+            break
+        logging.info(f"Archived {total} interactions.")
+        time.sleep(pause)
+    return total
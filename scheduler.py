@@ -0,0 +1,186 @@
+# scheduler.py
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+import redis.asyncio as redis
+
+from cache import CACHE_LOCAL_TTL, encode_body, pack, unpack
+from locks import acquire_lock, new_token, release_lock, renew_lock
+
+RESULT_PREFIX = "precomputed:"
+VERSION_PREFIX = "precomputed_version:"
+LEADER_KEY = "scheduler:leader"
+LAST_RUN_KEY = "scheduler:last_run"
+
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "1"))
+# Lease of the leader lock, renewed every tick; another worker takes over once it lapses
+SCHEDULER_LEADER_TTL = float(os.getenv("SCHEDULER_LEADER_TTL", "15"))
+# Delay before a failed job is tried again (capped by its own interval)
+SCHEDULER_RETRY_INTERVAL = float(os.getenv("SCHEDULER_RETRY_INTERVAL", "60"))
+
+# Refresh periods (seconds) of the precomputed statistics
+USAGE_STATS_INTERVAL = float(os.getenv("USAGE_STATS_INTERVAL", "5"))
+INTERACTIONS_STATS_INTERVAL = float(os.getenv("INTERACTIONS_STATS_INTERVAL", "5"))
+FEEDBACK_STATS_INTERVAL = float(os.getenv("FEEDBACK_STATS_INTERVAL", "3600"))
+
+
+class Job:
+    def __init__(self, name, compute, interval, publish=True):
+        self.name = name
+        # compute: coroutine function; its JSON-serializable result is published as the
+        # response body {name: result, "version": ..., "computed_at": ...}
+        self.compute = compute
+        self.interval = interval
+        self.publish = publish
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+
+
+class Scheduler:
+    # Every worker runs the loop, but only the holder of the Redis leader lock runs jobs.
+    # Results are published to Redis with an increasing version, already encoded as the
+    # response body; endpoints only read them. The Redis client must not decode responses.
+    # The time of each job's last run is kept in Redis too, so a new leader picks up the
+    # schedule where the previous one left it.
+    def __init__(self, redis_client=None, tick=SCHEDULER_TICK, leader_ttl=SCHEDULER_LEADER_TTL,
+                 retry_interval=SCHEDULER_RETRY_INTERVAL, local_ttl=CACHE_LOCAL_TTL):
+        self.redis = redis_client
+        self.tick = tick
+        self.leader_ttl = leader_ttl
+        self.retry_interval = retry_interval
+        self.local_ttl = local_ttl
+        self.token = new_token()
+        self.jobs = {}
+        # name -> task running the job in this process
+        self.running = {}
+        # name -> ((body, encoding), checked_until)
+        self.local = {}
+        self.leader = False
+        self.task = None
+
+    def add_job(self, name, compute, interval, publish=True):
+        self.jobs[name] = Job(name, compute, interval, publish)
+
+    async def _lead(self):
+        # Takes the leader lock, or extends it if this worker already holds it
+        if await acquire_lock(self.redis, LEADER_KEY, self.leader_ttl, self.token):
+            return True
+        return await renew_lock(self.redis, LEADER_KEY, self.token, self.leader_ttl)
+
+    async def _resign(self):
+        await release_lock(self.redis, LEADER_KEY, self.token)
+
+    async def _publish(self, name, value, computed_at, duration):
+        version = await self.redis.incr(VERSION_PREFIX + name)
+        computed_at = datetime.fromtimestamp(computed_at).isoformat()
+        body, encoding = encode_body({name: value, "version": version, "computed_at": computed_at})
+        header = {"encoding": encoding, "version": version, "computed_at": computed_at, "duration": duration}
+        await self.redis.set(RESULT_PREFIX + name, pack(header, body))
+        self.local[name] = ((body, encoding), time.time() + self.local_ttl)
+
+    async def _retry_soon(self, job, start):
+        retry_at = start + min(self.retry_interval, job.interval)
+        await self.redis.hset(LAST_RUN_KEY, job.name, retry_at - job.interval)
+
+    async def _run_job(self, job):
+        start = time.time()
+        try:
+            # Recorded up front so a leader taking over mid-run does not start it again
+            await self.redis.hset(LAST_RUN_KEY, job.name, start)
+            value = await job.compute()
+            if isinstance(value, dict) and "error" in value:
+                # Never published: the previous result stays until a run succeeds
+                raise RuntimeError(value["error"])
+            job.last_duration = time.time() - start
+            if job.publish:
+                await self._publish(job.name, value, start, job.last_duration)
+            job.runs += 1
+            if isinstance(value, dict) and "message" in value:
+                # Placeholder (e.g. not enough data yet): served, but computed again soon
+                await self._retry_soon(job, start)
+        except Exception as e:
+            job.failures += 1
+            logging.error(f"Scheduled job {job.name} failed: {e}")
+            try:
+                await self._retry_soon(job, start)
+            except redis.RedisError:
+                pass
+
+    async def _start_due_jobs(self):
+        last_runs = await self.redis.hgetall(LAST_RUN_KEY)
+        now = time.time()
+        for job in self.jobs.values():
+            if job.name in self.running:
+                continue
+            if float(last_runs.get(job.name.encode(), 0)) + job.interval > now:
+                continue
+            task = asyncio.create_task(self._run_job(job))
+            self.running[job.name] = task
+            task.add_done_callback(lambda _, name=job.name: self.running.pop(name, None))
+
+    async def run(self):
+        while True:
+            try:
+                leader = await self._lead()
+                if leader != self.leader:
+                    logging.info("Scheduler leadership acquired." if leader else "Scheduler leadership lost.")
+                self.leader = leader
+                if leader:
+                    await self._start_due_jobs()
+            except redis.RedisError as e:
+                self.leader = False
+                logging.error(f"Scheduler tick failed: {e}")
+            await asyncio.sleep(self.tick)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for task in list(self.running.values()):
+            task.cancel()
+        if self.leader:
+            try:
+                await self._resign()
+            except redis.RedisError:
+                pass
+            self.leader = False
+
+    async def run_now(self, name):
+        # Makes the job due: the leader starts it on its next tick
+        await self.redis.hdel(LAST_RUN_KEY, name)
+
+    async def read(self, name):
+        # Latest published (body, encoding), or None
+        cached = self.local.get(name)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        raw = await self.redis.get(RESULT_PREFIX + name)
+        if raw is None:
+            return None
+        header, body = unpack(raw)
+        self.local[name] = ((body, header["encoding"]), time.time() + self.local_ttl)
+        return self.local[name][0]
+
+    def stats(self):
+        return {
+            "leader": int(self.leader),
+            "jobs": {
+                name: {
+                    "interval": job.interval,
+                    "running": int(name in self.running),
+                    "runs": job.runs,
+                    "failures": job.failures,
+                    "last_duration": job.last_duration,
+                }
+                for name, job in sorted(self.jobs.items())
+            },
+        }
+
+
+scheduler = Scheduler()
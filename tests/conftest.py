@@ -0,0 +1,54 @@
+# tests/conftest.py
+# Runs offline like the benchmarks: a SQLite file and an in-memory Redis stand-in
+import os
+import tempfile
+
+import pytest
+
+from benchmarks.run import start_fake_redis
+
+WORKDIR = tempfile.mkdtemp(prefix="statsapi-tests-")
+fake_redis, redis_url = start_fake_redis()
+
+# The application reads its configuration at import time
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'tests.db')}"
+os.environ["REDIS_URL"] = redis_url
+os.environ["FEEDBACK_MODEL_PATH"] = os.path.join(WORKDIR, "feedback_model.joblib")
+os.environ["BCRYPT_ROUNDS"] = "4"
+# Trigrams are maintained too, so every derived table is covered
+os.environ["PREDICTION_MARKOV_ORDER"] = "2"
+
+import interactions  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    fake_redis.shutdown()
+    fake_redis.server_close()
+
+
+@pytest.fixture(scope="session")
+def schema():
+    interactions.init_db()
+
+
+@pytest.fixture(autouse=True)
+def clean_db(schema):
+    # Every test starts from empty tables; the actions dictionary cache goes with them
+    with interactions.engine.begin() as connection:
+        for table in reversed(interactions.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    interactions._action_ids.clear()
+    interactions._action_names.clear()
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    from app import app
+    from jwtUtils import create_access_token
+
+    with TestClient(app) as test_client:
+        token = create_access_token({"sub": "admin", "role": "admin"})
+        test_client.headers["Authorization"] = f"Bearer {token}"
+        yield test_client
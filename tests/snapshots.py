@@ -0,0 +1,24 @@
+# tests/snapshots.py
+from sqlalchemy import MetaData, select
+
+DERIVED_TABLES = ["action_transitions", "action_trigrams", "user_last_actions", "action_rollups", "user_rollups"]
+
+
+def derived_tables(bind):
+    # table -> sorted rows, action ids decoded to names so that databases which numbered
+    # their actions differently still compare equal
+    metadata = MetaData()
+    metadata.reflect(bind=bind, only=["actions", *DERIVED_TABLES])
+    with bind.connect() as connection:
+        actions = dict(connection.execute(select(metadata.tables["actions"].c.id, metadata.tables["actions"].c.name)).all())
+        snapshot = {}
+        for name in DERIVED_TABLES:
+            table = metadata.tables[name]
+            rows = []
+            for row in connection.execute(select(table)).mappings():
+                rows.append(tuple(
+                    (column, actions.get(value) if column.endswith("action_id") else str(value))
+                    for column, value in sorted(row.items())
+                ))
+            snapshot[name] = sorted(rows)
+    return snapshot
@@ -0,0 +1,68 @@
+# tests/test_migrations.py
+# A database created by an older version must end up like a fresh one with the same history
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+import interactions
+from interactions import insert_interactions
+from migrations import MIGRATIONS, migrate
+from tests.conftest import WORKDIR
+from tests.snapshots import derived_tables
+
+# Schema at version 4: actions stored by name, no dictionary table
+V4_SCHEMA = """
+CREATE TABLE interactions (id INTEGER PRIMARY KEY, username VARCHAR, action VARCHAR, timestamp DATETIME);
+CREATE INDEX ix_interactions_username_timestamp ON interactions (username, timestamp);
+CREATE INDEX ix_interactions_action ON interactions (action);
+CREATE TABLE action_transitions (username VARCHAR, from_action VARCHAR, to_action VARCHAR, count INTEGER,
+    PRIMARY KEY (username, from_action, to_action));
+CREATE TABLE user_last_actions (username VARCHAR PRIMARY KEY, action VARCHAR, timestamp DATETIME);
+CREATE TABLE action_rollups (granularity VARCHAR, bucket DATETIME, action VARCHAR, count INTEGER,
+    PRIMARY KEY (granularity, bucket, action));
+CREATE TABLE user_rollups (granularity VARCHAR, bucket DATETIME, username VARCHAR, count INTEGER,
+    PRIMARY KEY (granularity, bucket, username));
+CREATE TABLE users (username VARCHAR PRIMARY KEY, password VARCHAR, "isAdmin" BOOLEAN, location VARCHAR);
+CREATE TABLE schema_migrations (version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at DATETIME NOT NULL);
+"""
+
+
+def v4_database(path, rows):
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript(V4_SCHEMA)
+        connection.executemany(
+            "INSERT INTO schema_migrations VALUES (?, 'old', '2024-01-01 00:00:00.000000')",
+            [(version,) for version in range(1, 5)],
+        )
+        connection.executemany(
+            "INSERT INTO interactions (username, action, timestamp) VALUES (?, ?, ?)",
+            [(username, action, timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")) for username, action, timestamp in rows],
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_migrated_v4_database_matches_fresh_database():
+    start = datetime(2024, 1, 1)
+    rows = [
+        (f"user{index % 5}", "abcd"[(index * index) % 4], start + timedelta(minutes=7 * index))
+        for index in range(300)
+    ]
+    path = os.path.join(WORKDIR, "v4.db")
+    v4_database(path, rows)
+    upgraded = create_engine(f"sqlite:///{path}")
+    try:
+        assert migrate(upgraded) == [version for version, _, _ in MIGRATIONS if version > 4]
+        insert_interactions(rows)
+        assert derived_tables(upgraded) == derived_tables(interactions.engine)
+    finally:
+        upgraded.dispose()
+        os.remove(path)
+
+
+def test_migrations_are_idempotent():
+    assert migrate(interactions.engine) == []
@@ -0,0 +1,61 @@
+# tests/test_time_bounds.py
+# Timezone-aware from/to bounds are converted to the naive local time the rows are stored in
+import csv
+import io
+from datetime import datetime
+
+from interactions import to_local_naive
+
+EVENT = "2025-06-01T10:00:00+02:00"
+
+
+def seed(client):
+    response = client.post("/set/user-interactions/list", json=[{"username": "user", "action": "a", "timestamp": EVENT}])
+    assert response.status_code == 200
+
+
+def test_to_local_naive():
+    aware = datetime.fromisoformat(EVENT)
+    assert to_local_naive(aware) == aware.astimezone().replace(tzinfo=None)
+    assert to_local_naive(datetime(2025, 6, 1, 10)) == datetime(2025, 6, 1, 10)
+    assert to_local_naive(None) is None
+
+
+def test_timeseries_accepts_aware_bounds(client):
+    seed(client)
+    response = client.get("/stats/timeseries", params={"from": "2025-06-01T00:00:00Z", "to": "2025-06-02T00:00:00Z"})
+    assert response.status_code == 200
+    assert [point["count"] for point in response.json()["timeseries"]] == [1]
+
+    response = client.get("/stats/timeseries/users", params={"from": "2025-06-01T00:00:00Z", "to": "2025-06-02T00:00:00Z"})
+    assert response.status_code == 200
+    assert [point["username"] for point in response.json()["timeseries"]] == ["user"]
+
+
+def test_timeseries_rejects_empty_range(client):
+    response = client.get("/stats/timeseries", params={"from": "2025-06-02T00:00:00Z", "to": "2025-06-01T00:00:00+02:00"})
+    assert response.status_code == 400
+
+
+def test_interactions_filter_on_aware_bounds(client):
+    seed(client)
+    # The same instant written with two offsets selects the same row
+    for since, until in (("2025-06-01T07:30:00Z", "2025-06-01T08:30:00Z"),
+                         ("2025-06-01T09:30:00+02:00", "2025-06-01T10:30:00+02:00")):
+        response = client.get("/interactions", params={"from": since, "to": until})
+        assert response.status_code == 200
+        assert [row["action"] for row in response.json()] == ["a"]
+
+    response = client.get("/interactions", params={"from": "2025-06-01T08:00:01Z"})
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_export_filters_on_aware_bounds(client):
+    seed(client)
+    response = client.get("/export/interactions", params={"from": "2025-06-01T07:30:00Z", "to": "2025-06-01T08:30:00Z"})
+    assert response.status_code == 200
+    assert [row["action"] for row in csv.DictReader(io.StringIO(response.text))] == ["a"]
+
+    response = client.get("/export/interactions", params={"from": "2025-06-01T10:30:00+02:00"})
+    assert list(csv.DictReader(io.StringIO(response.text))) == []
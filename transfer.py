@@ -0,0 +1,258 @@
+# transfer.py
+import csv
+import io
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from interactions import (
+    Interaction, get_session, get_action_ids, iter_interactions, _compact_rollups, _rebuild_transitions
+)
+
+TRANSFER_FORMATS = ["csv", "parquet"]
+# Rows per exported Parquet row group, and per transaction on import
+TRANSFER_CHUNK_SIZE = int(os.getenv("TRANSFER_CHUNK_SIZE", "100000"))
+# Users whose transitions are recounted per transaction after an import
+TRANSFER_REBUILD_USERS = int(os.getenv("TRANSFER_REBUILD_USERS", "500"))
+
+EXPORT_COLUMNS = ["id", "username", "action", "timestamp"]
+IMPORT_COLUMNS = ["username", "action", "timestamp"]
+# A NULL timestamp (rows from before timestamps were recorded) is an empty CSV field both
+# ways, and a null in Parquet
+
+
+def _pyarrow():
+    # pyarrow is heavy to import and only needed for Parquet
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise NotImplementedError("Parquet support requires pyarrow")
+    return pyarrow
+
+
+def _check_format(format):
+    if format not in TRANSFER_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(TRANSFER_FORMATS)}")
+    if format == "parquet":
+        _pyarrow()
+
+
+def _parse_timestamp(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class _Chunks:
+    # Write-only file object collecting what the Parquet writer produces between two drains
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def _export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        writer.writerows(
+            (row["id"], row["username"], row["action"], row["timestamp"].isoformat() if row["timestamp"] else "")
+            for row in chunk
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _export_parquet(chunks):
+    pa = _pyarrow()
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("username", pa.string()),
+        ("action", pa.string()),
+        ("timestamp", pa.timestamp("us")),
+    ])
+    sink = _Chunks()
+    writer = pa.parquet.ParquetWriter(sink, schema)
+    try:
+        for chunk in chunks:
+            # One row group per chunk
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_interactions(format="csv", username=None, since=None, until=None, chunk_size=TRANSFER_CHUNK_SIZE):
+    # Yields the encoded file piece by piece; rows come from a server-side cursor in id
+    # order, so memory stays bounded by chunk_size whatever the table size
+    _check_format(format)
+    chunks = iter_interactions(username, since, until, chunk_size)
+    if format == "parquet":
+        return _export_parquet(chunks)
+    return _export_csv(chunks)
+
+
+def read_csv_rows(file, chunk_size=TRANSFER_CHUNK_SIZE):
+    # file: text file with a header; extra columns (e.g. the exported id) are ignored
+    reader = csv.DictReader(file)
+    missing = set(IMPORT_COLUMNS) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"Missing CSV columns: {', '.join(sorted(missing))}")
+    rows = []
+    for row in reader:
+        try:
+            if not row["username"] or not row["action"]:
+                raise ValueError("username and action are required")
+            rows.append((row["username"], row["action"], _parse_timestamp(row["timestamp"])))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid row on line {reader.line_num}: {e}")
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def read_parquet_rows(path, chunk_size=TRANSFER_CHUNK_SIZE):
+    pa = _pyarrow()
+    parquet_file = pa.parquet.ParquetFile(path)
+    missing = set(IMPORT_COLUMNS) - set(parquet_file.schema_arrow.names)
+    if missing:
+        raise ValueError(f"Missing Parquet columns: {', '.join(sorted(missing))}")
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=IMPORT_COLUMNS):
+        rows = []
+        for username, action, timestamp in zip(*(column.to_pylist() for column in batch.columns)):
+            if not username or not action:
+                raise ValueError("username and action are required")
+            rows.append((username, action, _parse_timestamp(timestamp)))
+        yield rows
+
+
+def read_rows(path, format, chunk_size=TRANSFER_CHUNK_SIZE):
+    _check_format(format)
+    if format == "parquet":
+        yield from read_parquet_rows(path, chunk_size)
+        return
+    with open(path, newline="") as file:
+        yield from read_csv_rows(file, chunk_size)
+
+
+def _copy_rows(db, rows):
+    # PostgreSQL: stream the chunk through COPY instead of binding every value
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY interactions (username, action_id, timestamp) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+    finally:
+        cursor.close()
+
+
+def _load_rows(db, rows):
+    action_ids = get_action_ids(db, {action for _, action, _ in rows})
+    rows = [(username, action_ids[action], timestamp) for username, action, timestamp in rows]
+    if db.get_bind().dialect.name == "postgresql":
+        _copy_rows(db, rows)
+    else:
+        db.execute(insert(Interaction), [
+            {"username": username, "action_id": action_id, "timestamp": timestamp}
+            for username, action_id, timestamp in rows
+        ])
+
+
+def rebuild_derived(since, until, usernames=None):
+    # Imported rows can predate what is already stored, so the derived tables are
+    # recomputed instead of being updated row by row: the rollups of the imported period
+    # (None when no imported row has a timestamp), and the transitions of the imported
+    # users (everyone when usernames is None), a few users per transaction so live
+    # ingestion for the others is never held up for long
+    db = get_session()
+    try:
+        if since is not None:
+            _compact_rollups(db, since, until)
+        if usernames is None:
+            _rebuild_transitions(db)
+        db.commit()
+        if usernames is not None:
+            usernames = sorted(usernames)
+            for start in range(0, len(usernames), TRANSFER_REBUILD_USERS):
+                _rebuild_transitions(db, usernames=usernames[start:start + TRANSFER_REBUILD_USERS])
+                db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Error rebuilding derived tables after import: {e}")
+        raise
+    finally:
+        db.close()
+
+
+def import_interactions(chunks, rebuild=True):
+    # chunks: iterable of lists of (username, action, timestamp), one transaction each.
+    # Returns the number of rows written.
+    total = 0
+    first = last = None
+    usernames = set()
+    try:
+        for rows in chunks:
+            db = get_session()
+            try:
+                _load_rows(db, rows)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                logging.error(f"Error importing interactions after {total} rows: {e}")
+                raise
+            finally:
+                db.close()
+            total += len(rows)
+            usernames.update(username for username, _, _ in rows)
+            timestamps = [timestamp for _, _, timestamp in rows if timestamp is not None]
+            if timestamps:
+                low, high = min(timestamps), max(timestamps)
+                first = low if first is None else min(first, low)
+                last = high if last is None else max(last, high)
+            logging.info(f"Imported {total} interactions.")
+    finally:
+        # Committed chunks stay, so their derived rows are rebuilt even if a later one failed
+        if rebuild and total:
+            until = None if last is None else last + timedelta(microseconds=1)
+            rebuild_derived(first, until, usernames)
+    return total
+
+
+def import_file(path, format="csv", chunk_size=TRANSFER_CHUNK_SIZE, rebuild=True):
+    return import_interactions(read_rows(path, format, chunk_size), rebuild)
@@ -1,129 +1,273 @@
 # compute_stats.py
-from interactions import get_session, Interaction
-from sqlalchemy import func
-import pandas as pd
-from sklearn.cluster import KMeans
-import asyncio
+from interactions import get_session, get_async_session, Interaction, ArchivedInteractionCount, ArchivedLastAction, ActionTransition, ActionTrigram, UserLastAction, PREDICTION_MARKOV_ORDER, ActionRollup, UserRollup, truncate_timestamp, get_action_ids, get_action_names
+from sqlalchemy import BigInteger, cast, func, select, union, union_all
+from metrics import COMPUTE_DURATION, timed
+from analytics import analytics_pool
+import logging
+import os
+import time
 from collections import defaultdict
-import numpy as np
-from sklearn.preprocessing import LabelEncoder
 
+# Each query is built once and run by both the sync functions (scripts, threads) and
+# their native async counterparts used by the API. Interactions moved out of the hot table
+# by the retention job are counted through their archived aggregates.
+TOTAL_INTERACTIONS_QUERY = select(
+    select(func.count(Interaction.id)).scalar_subquery()
+    + select(func.coalesce(func.sum(ArchivedLastAction.interaction_count), 0)).scalar_subquery()
+)
+TOTAL_USERS_QUERY = select(func.count()).select_from(
+    union(select(Interaction.username), select(ArchivedLastAction.username)).subquery()
+)
+_interactions_per_user = union_all(
+    select(Interaction.username, func.count(Interaction.id).label('interaction_count')).group_by(Interaction.username),
+    select(ArchivedLastAction.username, ArchivedLastAction.interaction_count),
+).subquery()
+INTERACTIONS_PER_USER_QUERY = select(
+    _interactions_per_user.c.username,
+    cast(func.sum(_interactions_per_user.c.interaction_count), BigInteger).label('interaction_count')
+).group_by(_interactions_per_user.c.username)
+
+@timed("compute_usage_stats")
 def compute_usage_stats_sync():
     db = get_session()
-    # Compute total number of interactions
-    total_interactions = db.query(func.count(Interaction.id)).scalar()
-    # Compute total number of users
-    total_users = db.query(Interaction.username).distinct().count()
-    db.close()
+    try:
+        # Compute total number of interactions
+        total_interactions = db.scalar(TOTAL_INTERACTIONS_QUERY)
+        # Compute total number of users
+        total_users = db.scalar(TOTAL_USERS_QUERY)
+    finally:
+        db.close()
     return {"total_interactions": total_interactions, "total_users": total_users}
 
+@timed("compute_usage_stats")
 async def compute_usage_stats():
-    return await asyncio.to_thread(compute_usage_stats_sync)
+    async with get_async_session() as db:
+        total_interactions = await db.scalar(TOTAL_INTERACTIONS_QUERY)
+        total_users = await db.scalar(TOTAL_USERS_QUERY)
+    return {"total_interactions": total_interactions, "total_users": total_users}
 
+@timed("compute_interactions_stats")
 def compute_interactions_stats_sync():
     db = get_session()
-    # Compute interactions per user
-    interactions_per_user = db.query(
-        Interaction.username,
-        func.count(Interaction.id).label('interaction_count')
-    ).group_by(Interaction.username).all()
-    db.close()
+    try:
+        # Compute interactions per user
+        interactions_per_user = db.execute(INTERACTIONS_PER_USER_QUERY).all()
+    finally:
+        db.close()
     # Convert to list of dicts
     results = [{"username": row[0], "interaction_count": row[1]} for row in interactions_per_user]
     return results
 
+@timed("compute_interactions_stats")
 async def compute_interactions_stats():
-    return await asyncio.to_thread(compute_interactions_stats_sync)
+    async with get_async_session() as db:
+        interactions_per_user = (await db.execute(INTERACTIONS_PER_USER_QUERY)).all()
+    return [{"username": row[0], "interaction_count": row[1]} for row in interactions_per_user]
 
-def compute_feedback_stats_sync():
-    db = get_session()
-    # Fetch interactions data
-    interactions = db.query(Interaction).all()
-    db.close()
-    
-    # Prepare data for clustering
-    data = {}
-    for interaction in interactions:
-        username = interaction.username
-        action = interaction.action
-        if username not in data:
-            data[username] = {}
-        if action not in data[username]:
-            data[username][action] = 0
-        data[username][action] +=1
-
-    # Create DataFrame
-    df = pd.DataFrame.from_dict(data, orient='index').fillna(0)
-    if df.empty:
-        return {"message": "Not enough data to compute feedback stats."}
+FEEDBACK_N_CLUSTERS = int(os.getenv("FEEDBACK_N_CLUSTERS", "3"))
+FEEDBACK_RANDOM_STATE = int(os.getenv("FEEDBACK_RANDOM_STATE", "0"))
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", "4096"))
+# Initial width of the feature space; each action's column is its dictionary id
+FEEDBACK_MAX_ACTIONS = int(os.getenv("FEEDBACK_MAX_ACTIONS", "256"))
+FEEDBACK_MODEL_PATH = os.getenv("FEEDBACK_MODEL_PATH", "feedback_model.joblib")
 
-    # Perform clustering
+# The analytics stack (numpy, scipy, scikit-learn, joblib) is imported inside the functions
+# using it: API workers that never run them do not pay its import time and memory
+
+def load_feedback_model():
+    import joblib
     try:
-        kmeans = KMeans(n_clusters=3)
-        clusters = kmeans.fit_predict(df)
-        df['cluster'] = clusters
+        state = joblib.load(FEEDBACK_MODEL_PATH)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        return {"error": str(e)}
+        logging.warning(f"Ignoring unreadable feedback model {FEEDBACK_MODEL_PATH}: {e}")
+        return None
+    if state["n_clusters"] != FEEDBACK_N_CLUSTERS or state["random_state"] != FEEDBACK_RANDOM_STATE:
+        return None
+    if state.get("columns") != "action_id":
+        # Saved before columns were keyed by action id
+        return None
+    return state
 
-    # Return cluster assignments
-    cluster_assignments = df['cluster'].to_dict()
-    results = [{"username": username, "cluster": int(cluster)} for username, cluster in cluster_assignments.items()]
-    return results
+def save_feedback_model(state):
+    import joblib
+    tmp_path = f"{FEEDBACK_MODEL_PATH}.tmp"
+    joblib.dump(state, tmp_path)
+    os.replace(tmp_path, FEEDBACK_MODEL_PATH)
 
-async def compute_feedback_stats():
-    return await asyncio.to_thread(compute_feedback_stats_sync)
+def new_feedback_model(n_features=FEEDBACK_MAX_ACTIONS):
+    from sklearn.cluster import MiniBatchKMeans
+    return {
+        "model": MiniBatchKMeans(
+            n_clusters=FEEDBACK_N_CLUSTERS,
+            random_state=FEEDBACK_RANDOM_STATE,
+            batch_size=FEEDBACK_BATCH_SIZE,
+            n_init=3,
+        ),
+        "columns": "action_id",
+        "n_features": n_features,
+        "n_clusters": FEEDBACK_N_CLUSTERS,
+        "random_state": FEEDBACK_RANDOM_STATE,
+    }
 
+def load_user_action_matrix(n_features):
+    # Counts per (username, action id), hot and archived, are aggregated by the database
+    # and packed into a sparse users x actions matrix, action id N in column N - 1
+    import numpy as np
+    from scipy import sparse
+    db = get_session()
+    try:
+        combined = union_all(
+            select(Interaction.username, Interaction.action_id, func.count(Interaction.id).label('count'))
+            .group_by(Interaction.username, Interaction.action_id),
+            select(ArchivedInteractionCount.username, ArchivedInteractionCount.action_id, ArchivedInteractionCount.count),
+        ).subquery()
+        counts = db.execute(
+            select(combined.c.username, combined.c.action_id, func.sum(combined.c.count))
+            .group_by(combined.c.username, combined.c.action_id)
+            .execution_options(yield_per=50000)
+        )
 
-def predict_next_action_sync(username):
+        users = {}
+        rows, cols, values = [], [], []
+        for username, action_id, count in counts:
+            rows.append(users.setdefault(username, len(users)))
+            cols.append(action_id - 1)
+            values.append(count)
+    finally:
+        db.close()
+
+    cols = np.asarray(cols, dtype=np.int64)
+    matrix = sparse.csr_matrix(
+        (np.asarray(values, dtype=np.float64), (rows, cols)),
+        shape=(len(users), max(n_features, int(cols.max()) + 1 if len(cols) else 0)),
+    )
+    return list(users), matrix
+
+ROLLUP_MAX_BUCKETS = int(os.getenv("ROLLUP_MAX_BUCKETS", "10000"))
+
+def _timeseries_query(model, key_column, key, since, until, granularity):
+    # Reads only the pre-aggregated buckets, never the raw interactions
+    query = select(model.bucket, key_column, model.count).where(
+        model.granularity == granularity,
+        model.bucket >= truncate_timestamp(since, granularity),
+        model.bucket < until
+    )
+    if key is not None:
+        query = query.where(key_column == key)
+    return query.order_by(model.bucket, key_column)
+
+def _action_timeseries(db, since, until, granularity, action=None):
+    action_id = None
+    if action is not None:
+        action_id = get_action_ids(db, [action], create=False).get(action)
+        if action_id is None:
+            return []
+    rows = db.execute(_timeseries_query(ActionRollup, ActionRollup.action_id, action_id, since, until, granularity)).all()
+    names = get_action_names(db, {action_id for _, action_id, _ in rows})
+    return [{"bucket": bucket, "action": names[action_id], "count": count} for bucket, action_id, count in rows]
+
+def get_action_timeseries_sync(since, until, granularity, action=None):
+    db = get_session()
     try:
-        db = get_session()
-        # Fetch interactions for the user, ordered by timestamp
-        user_interactions = db.query(Interaction).filter_by(username=username).order_by(Interaction.timestamp).all()
+        return _action_timeseries(db, since, until, granularity, action)
+    finally:
+        db.close()
+
+async def get_action_timeseries(since, until, granularity, action=None):
+    async with get_async_session() as db:
+        return await db.run_sync(_action_timeseries, since, until, granularity, action)
+
+def get_user_timeseries_sync(since, until, granularity, username=None):
+    db = get_session()
+    try:
+        rows = db.execute(_timeseries_query(UserRollup, UserRollup.username, username, since, until, granularity)).all()
+    finally:
         db.close()
+    return [{"bucket": bucket, "username": username, "count": count} for bucket, username, count in rows]
+
+async def get_user_timeseries(since, until, granularity, username=None):
+    async with get_async_session() as db:
+        rows = (await db.execute(_timeseries_query(UserRollup, UserRollup.username, username, since, until, granularity))).all()
+    return [{"bucket": bucket, "username": username, "count": count} for bucket, username, count in rows]
 
-        if not user_interactions:
-            return {"message": f"Aucune interaction trouvée pour l'utilisateur {username}"}
+def _feedback_stats():
+    # Runs in an analytics worker process: metrics recorded here would stay in that
+    # process, so the clustering time is returned to be observed by the caller
+    state = load_feedback_model() or new_feedback_model()
+    usernames, matrix = load_user_action_matrix(state["n_features"])
+    if len(usernames) < state["n_clusters"]:
+        # k-means needs at least one user per cluster
+        return {"message": "Not enough data to compute feedback stats."}, None
 
-        # Extract the sequence of actions
-        actions_sequence = [interaction.action for interaction in user_interactions]
+    if matrix.shape[1] > state["n_features"]:
+        # Action ids outgrew the feature space: start a wider model from scratch
+        logging.warning(f"More than {state['n_features']} distinct actions, refitting feedback clusters from scratch")
+        state = new_feedback_model(max(2 * state["n_features"], matrix.shape[1]))
+        matrix.resize((matrix.shape[0], state["n_features"]))
 
-        # Build the list of unique actions
-        all_actions = list(set(actions_sequence))
+    # Perform clustering
+    try:
+        model = state["model"]
+        started = time.perf_counter()
+        for start in range(0, matrix.shape[0], FEEDBACK_BATCH_SIZE):
+            model.partial_fit(matrix[start:start + FEEDBACK_BATCH_SIZE])
+        clusters = model.predict(matrix)
+        kmeans_seconds = time.perf_counter() - started
+    except Exception as e:
+        return {"error": str(e)}, None
 
-        # Encode actions as integers
-        le = LabelEncoder()
-        le.fit(all_actions)
-        encoded_actions = le.transform(actions_sequence)
+    save_feedback_model(state)
 
-        # Build the transition matrix
-        n_actions = len(le.classes_)
-        transition_matrix = np.zeros((n_actions, n_actions))
+    # Return cluster assignments
+    return [{"username": username, "cluster": int(cluster)} for username, cluster in zip(usernames, clusters)], kmeans_seconds
 
-        for (current_action, next_action) in zip(encoded_actions[:-1], encoded_actions[1:]):
-            transition_matrix[current_action][next_action] += 1
+def _observe_kmeans(kmeans_seconds):
+    if kmeans_seconds is not None:
+        COMPUTE_DURATION.labels("kmeans").observe(kmeans_seconds)
 
-        # Normalize the transition matrix to get probabilities
-        row_sums = transition_matrix.sum(axis=1)
-        row_sums[row_sums == 0] = 1  # Avoid division by zero
-        transition_prob_matrix = transition_matrix / row_sums[:, np.newaxis]
+@timed("compute_feedback_stats")
+def compute_feedback_stats_sync():
+    result, kmeans_seconds = _feedback_stats()
+    _observe_kmeans(kmeans_seconds)
+    return result
 
-        # Get the last action performed by the user
-        last_action = actions_sequence[-1]
-        last_action_encoded = le.transform([last_action])[0]
+@timed("compute_feedback_stats")
+async def compute_feedback_stats():
+    # Clustering runs in the analytics worker processes, off the API's threads
+    result, kmeans_seconds = await analytics_pool.run(_feedback_stats)
+    _observe_kmeans(kmeans_seconds)
+    return result
 
-        # Predict the next action
-        next_action_probs = transition_prob_matrix[last_action_encoded]
 
-        if np.all(next_action_probs == 0):
-            return {"message": f"Aucune donnée de transition disponible après l'action '{last_action}' pour l'utilisateur {username}"}
+def _transitions_query(username, last_action_id):
+    return select(ActionTransition.to_action_id, ActionTransition.count).where(
+        ActionTransition.username == username,
+        ActionTransition.from_action_id == last_action_id,
+        ActionTransition.count > 0
+    )
 
-        predicted_next_action_encoded = np.argmax(next_action_probs)
-        predicted_next_action = le.inverse_transform([predicted_next_action_encoded])[0]
-        probability = next_action_probs[predicted_next_action_encoded]
+def _load_prediction_inputs(db, username):
+    # Last action and the counts of what followed it, decoded to action names
+    last = db.get(UserLastAction, username)
+    if last is None or last.action_id is None:
+        return None, []
+    transitions = db.execute(_transitions_query(username, last.action_id)).all()
+    names = get_action_names(db, {last.action_id, *(action_id for action_id, _ in transitions)})
+    return names[last.action_id], [(names[action_id], count) for action_id, count in transitions]
+
+def _prediction(username, last_action, transitions):
+    if last_action is None:
+        return {"message": f"Aucune interaction trouvée pour l'utilisateur {username}"}
+
+    if not transitions:
+        return {"message": f"Aucune donnée de transition disponible après l'action '{last_action}' pour l'utilisateur {username}"}
+
+    # Highest count wins, ties go to the alphabetically first action
+    predicted_next_action, count = min(transitions, key=lambda row: (-row[1], row[0]))
+    probability = count / sum(row[1] for row in transitions)
 
-    except Exception as e:
-        return {"error": str(e)}
-    
     return {
         "username": username,
         "last_action": last_action,
@@ -131,5 +275,128 @@ def predict_next_action_sync(username):
         "probability": float(probability)
     }
 
+def predict_next_action_sync(username):
+    try:
+        db = get_session()
+        try:
+            # The transition counts are maintained on insert, so this is a single-row lookup
+            last_action, transitions = _load_prediction_inputs(db, username)
+        finally:
+            db.close()
+        return _prediction(username, last_action, transitions)
+    except Exception as e:
+        return {"error": str(e)}
+
 async def predict_next_action(username):
-    return await asyncio.to_thread(predict_next_action_sync, username)
\ No newline at end of file
+    try:
+        async with get_async_session() as db:
+            last_action, transitions = await db.run_sync(_load_prediction_inputs, username)
+        return _prediction(username, last_action, transitions)
+    except Exception as e:
+        return {"error": str(e)}
+
+# Trigram contexts seen fewer times than this fall back to the bigram counts
+PREDICTION_MIN_CONTEXT_COUNT = int(os.getenv("PREDICTION_MIN_CONTEXT_COUNT", "3"))
+PREDICTION_BATCH_MAX_USERS = int(os.getenv("PREDICTION_BATCH_MAX_USERS", "10000"))
+
+def _top_k(users, actions, counts, n_users, k, name_rank):
+    # For each user, the k highest counts (ties by action name) and their share of the
+    # user's total, in a few array operations over all users at once
+    import numpy as np
+    totals = np.bincount(users, weights=counts, minlength=n_users)
+    order = np.lexsort((name_rank[actions], -counts, users))
+    sorted_users = users[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_users, sorted_users)
+    keep = order[rank < k]
+    return users[keep], actions[keep], counts[keep] / totals[users[keep]]
+
+def _predict_top_actions(db, usernames=None, since=None, k=3):
+    import numpy as np
+    if usernames is not None:
+        selected = UserLastAction.username.in_(usernames)
+    else:
+        selected = UserLastAction.timestamp >= since
+
+    # One query for every user: their last action and the bigram counts that follow it
+    bigrams = db.execute(
+        select(UserLastAction.username, UserLastAction.action_id, ActionTransition.to_action_id, ActionTransition.count)
+        .outerjoin(ActionTransition, (ActionTransition.username == UserLastAction.username)
+                   & (ActionTransition.from_action_id == UserLastAction.action_id)
+                   & (ActionTransition.count > 0))
+        .where(selected, UserLastAction.action_id.is_not(None))
+    ).all()
+    user_index = {}
+    last_actions = []
+    for username, action_id, _, _ in bigrams:
+        if username not in user_index:
+            user_index[username] = len(user_index)
+            last_actions.append(action_id)
+    rows = [(user_index[username], to_action, count) for username, _, to_action, count in bigrams if to_action is not None]
+    users, actions, counts = (np.asarray(column, dtype=np.int64) for column in zip(*rows)) if rows else (
+        np.empty(0, dtype=np.int64) for _ in range(3)
+    )
+    orders = np.ones(len(user_index), dtype=np.int64)
+
+    if PREDICTION_MARKOV_ORDER >= 2 and user_index:
+        trigrams = db.execute(
+            select(ActionTrigram.username, ActionTrigram.to_action_id, ActionTrigram.count)
+            .join(UserLastAction, (ActionTrigram.username == UserLastAction.username)
+                  & (ActionTrigram.before_action_id == UserLastAction.previous_action_id)
+                  & (ActionTrigram.from_action_id == UserLastAction.action_id))
+            .where(selected, ActionTrigram.count > 0)
+        ).all()
+        if trigrams:
+            tri_users = np.asarray([user_index[username] for username, _, _ in trigrams], dtype=np.int64)
+            tri_actions = np.asarray([action for _, action, _ in trigrams], dtype=np.int64)
+            tri_counts = np.asarray([count for _, _, count in trigrams], dtype=np.int64)
+            # Users whose (before, last) context is well supported switch to the trigram counts
+            supported = np.bincount(tri_users, weights=tri_counts, minlength=len(user_index)) >= PREDICTION_MIN_CONTEXT_COUNT
+            orders[supported] = 2
+            keep_bigrams = ~supported[users]
+            keep_trigrams = supported[tri_users]
+            users = np.concatenate([users[keep_bigrams], tri_users[keep_trigrams]])
+            actions = np.concatenate([actions[keep_bigrams], tri_actions[keep_trigrams]])
+            counts = np.concatenate([counts[keep_bigrams], tri_counts[keep_trigrams]])
+
+    names = get_action_names(db, {*last_actions, *actions.tolist()})
+    name_rank = np.zeros(max(names, default=0) + 1, dtype=np.int64)
+    for rank, action_id in enumerate(sorted(names, key=lambda action_id: names[action_id])):
+        name_rank[action_id] = rank
+    top_users, top_actions, probabilities = _top_k(users, actions, counts, len(user_index), k, name_rank)
+
+    predictions = [[] for _ in user_index]
+    for user, action_id, probability in zip(top_users.tolist(), top_actions.tolist(), probabilities.tolist()):
+        predictions[user].append({"action": names[action_id], "probability": probability})
+    results = [
+        {
+            "username": username,
+            "last_action": names[last_actions[index]],
+            "order": int(orders[index]),
+            "predictions": predictions[index],
+        }
+        for username, index in user_index.items()
+    ]
+    if usernames is not None:
+        position = {username: rank for rank, username in enumerate(usernames)}
+        results.sort(key=lambda result: position[result["username"]])
+        unknown = [username for username in dict.fromkeys(usernames) if username not in user_index]
+    else:
+        results.sort(key=lambda result: result["username"])
+        unknown = []
+    return {"k": k, "predictions": results, "unknown_usernames": unknown}
+
+def _predict_top_actions_job(usernames=None, since=None, k=3):
+    db = get_session()
+    try:
+        return _predict_top_actions(db, usernames, since, k)
+    finally:
+        db.close()
+
+@timed("predict_top_actions")
+def predict_top_actions_sync(usernames=None, since=None, k=3):
+    return _predict_top_actions_job(usernames, since, k)
+
+@timed("predict_top_actions")
+async def predict_top_actions(usernames=None, since=None, k=3):
+    # The numpy ranking runs in the analytics worker processes, like the clustering
+    return await analytics_pool.run(_predict_top_actions_job, usernames, since, k)